@@ -0,0 +1,565 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+import tracemalloc
+import urllib.request
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from netbox_sync import NetBox, SqliteFingerprintStore, SqliteIdCache
+
+FK_REFS = {
+    "region": "dcim/regions",
+    "site": "dcim/sites",
+    "location": "dcim/locations",
+    "rack": "dcim/racks",
+    "tenant": "tenancy/tenants",
+    "contact": "tenancy/contacts",
+    "manufacturer": "dcim/manufacturers",
+    "platform": "dcim/platforms",
+    "device_type": "dcim/device-types",
+    "device_role": "dcim/device-roles",
+    "device": "dcim/devices",
+    "untagged_vlan": "ipam/vlans",
+    "rir": "ipam/rirs",
+    "primary_ip4": "ipam/ip-addresses",
+}
+GROUP_REFS = {
+    "tenancy/tenants": "tenancy/tenant-groups",
+    "dcim/sites": "dcim/site-groups",
+    "dcim/locations": "dcim/locations",
+    "tenancy/contacts": "tenancy/contact-groups",
+}
+ROLE_REFS = {
+    "dcim/devices": "dcim/device-roles",
+    "tenancy/contact-assignments": "tenancy/contact-roles",
+}
+LIST_REFS = {
+    "tags": "extras/tags",
+    "tagged_vlans": "ipam/vlans",
+    "asns": "ipam/asns",
+}
+# Fields NetBox always returns, set or not; pynetbox fetches the full object when one is missing
+DEFAULT_FIELDS = {
+    "dcim/devices": ["device_role", "role", "platform", "site", "location", "rack", "tenant", "primary_ip4"],
+    "dcim/interfaces": ["device", "type", "lag", "parent", "mode", "untagged_vlan", "tagged_vlans"],
+    "ipam/vlans": ["vid", "site", "group", "tenant"],
+    "ipam/ip-addresses": ["address", "assigned_object_type", "assigned_object_id", "tenant"],
+}
+SELF_REFS = ["parent", "lag"]
+NESTED_FIELDS = ["name", "slug", "vid", "address", "model", "asn"]
+PAGE_PARAMS = ["limit", "offset", "brief", "fields", "ordering"]
+FILTER_ALIASES = {"time_after": "time__gte"}
+CHANGELOG = "extras/object-changes"
+MAX_PAGE_SIZE = 1000
+
+
+class FakeNetBoxStore:
+    def __init__(self, latency=0.0, jitter=0.0, throttle_rate=0.0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.objects = defaultdict(dict)
+            self.fields = defaultdict(lambda: {"description", "tags", "last_updated"})
+            for endpoint, fields in DEFAULT_FIELDS.items():
+                self.fields[endpoint].update(fields)
+            self.index = defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
+            self.next_id = Counter()
+            self.requests = Counter()
+
+    @staticmethod
+    def ref_endpoint(endpoint, field):
+        if field in SELF_REFS:
+            return endpoint
+        if field == "group":
+            return GROUP_REFS.get(endpoint)
+        if field == "role":
+            return ROLE_REFS.get(endpoint)
+        return FK_REFS.get(field)
+
+    @staticmethod
+    def index_values(value):
+        values = value if isinstance(value, list) else [value]
+        return {str(x).lower() for x in values if x is not None}
+
+    def nested(self, base, endpoint, obj_id):
+        obj = self.objects[endpoint].get(int(obj_id), {})
+        ret = {"id": int(obj_id), "url": f"{base}/api/{endpoint}/{obj_id}/"}
+        ret.update({x: obj[x] for x in NESTED_FIELDS if x in obj})
+        return ret
+
+    def render(self, base, endpoint, obj, brief=False, fields=None):
+        ret = {
+            "id": obj["id"],
+            "url": f"{base}/api/{endpoint}/{obj['id']}/",
+            "display": str(obj.get("name", obj["id"])),
+        }
+        for key in self.fields[endpoint]:
+            if brief and key not in NESTED_FIELDS:
+                continue
+            if fields and key not in fields:
+                continue
+            value = obj.get(key)
+            ref = self.ref_endpoint(endpoint, key)
+            if key in LIST_REFS:
+                value = [self.nested(base, LIST_REFS[key], x) for x in value or []]
+            elif ref and value is not None:
+                value = self.nested(base, ref, value)
+            ret[key] = value
+        return ret
+
+    def filter_ids(self, endpoint, params):
+        candidates = None
+        range_filters = []
+        for key, values in params.items():
+            if key in PAGE_PARAMS:
+                continue
+            key = FILTER_ALIASES.get(key, key)
+            if "__" in key:
+                range_filters.append((key, values))
+                continue
+            field = key
+            if key.endswith("_id") and key not in self.fields[endpoint]:
+                field = key[:-3]
+            if key == "id":
+                matched = {int(x) for x in values if int(x) in self.objects[endpoint]}
+            else:
+                field_index = self.index[endpoint][field]
+                matched = set().union(*(field_index.get(str(x).lower(), set()) for x in values))
+            candidates = matched if candidates is None else candidates & matched
+        if candidates is None:
+            candidates = self.objects[endpoint].keys()
+        for key, values in range_filters:
+            field, lookup = key.rsplit("__", 1)
+            if lookup != "gte":
+                raise ValueError(f"Unsupported lookup: {key}")
+            candidates = [x for x in candidates if str(self.objects[endpoint][x].get(field) or "") >= values[0]]
+        return sorted(candidates)
+
+    def write(self, endpoint, data, obj_id=None):
+        action = "update" if obj_id else "create"
+        if obj_id is None:
+            self.next_id[endpoint] += 1
+            obj_id = self.next_id[endpoint]
+            self.objects[endpoint][obj_id] = {"id": obj_id, "description": "", "tags": []}
+        elif obj_id not in self.objects[endpoint]:
+            return None
+        obj = self.objects[endpoint][obj_id]
+        for key, value in data.items():
+            if key == "id":
+                continue
+            if isinstance(value, dict) and "id" in value:
+                value = value["id"]
+            if isinstance(value, list):
+                value = [x["id"] if isinstance(x, dict) and "id" in x else x for x in value]
+            field_index = self.index[endpoint][key]
+            for x in self.index_values(obj.get(key)):
+                field_index[x].discard(obj_id)
+            for x in self.index_values(value):
+                field_index[x].add(obj_id)
+            obj[key] = value
+            self.fields[endpoint].add(key)
+        obj["last_updated"] = datetime.now(timezone.utc).isoformat()
+        self.log_change(endpoint, obj_id, action)
+        return obj
+
+    def delete(self, endpoint, obj_id):
+        obj = self.objects[endpoint].pop(obj_id, None)
+        for key, value in (obj or {}).items():
+            for x in self.index_values(value):
+                self.index[endpoint][key][x].discard(obj_id)
+        if obj:
+            self.log_change(endpoint, obj_id, "delete")
+
+    def log_change(self, endpoint, obj_id, action):
+        app_label, model = endpoint.split("/")
+        model = NetBox.nb_content_type(f"{app_label}.{model}")
+        self.next_id[CHANGELOG] += 1
+        change = {
+            "id": self.next_id[CHANGELOG],
+            "time": datetime.now(timezone.utc).isoformat(),
+            "action": action,
+            "changed_object_type": model,
+            "changed_object_id": obj_id,
+        }
+        self.objects[CHANGELOG][change["id"]] = change
+        for key in ("action", "changed_object_type", "changed_object_id"):
+            self.index[CHANGELOG][key][str(change[key])].add(change["id"])
+        self.fields[CHANGELOG].update(change)
+
+
+class FakeNetBoxHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately; without this every response waits on a delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("API-Version", "3.7")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def handle_control(self, verb, path):
+        store = self.store
+        if path == "/_benchmark/stats":
+            return self.reply(200, [[x, y, z] for (x, y), z in store.requests.items()])
+        if path == "/_benchmark/reset" and verb == "POST":
+            store.reset()
+            return self.reply(204)
+        if path == "/_benchmark/reset-stats" and verb == "POST":
+            store.requests.clear()
+            return self.reply(204)
+        return self.reply(404, {"detail": "Not found."})
+
+    def handle_graphql(self):
+        # Only answers the device tree query, by the device names in its variables
+        store = self.store
+        base = f"http://{self.headers['Host']}"
+        variables = (self.read_body() or {}).get("variables") or {}
+        objects = store.objects
+
+        def render_vlan(vlan_id):
+            vlan = objects["ipam/vlans"].get(vlan_id, {})
+            return {
+                "id": vlan_id,
+                "vid": vlan.get("vid"),
+                "last_updated": vlan.get("last_updated"),
+                "site": {"id": vlan["site"]} if vlan.get("site") else None,
+            }
+
+        with store.lock:
+            store.requests[("POST", "graphql")] += 1
+            device_list = []
+            for device_id in store.filter_ids("dcim/devices", {"name": variables.get("names") or []}):
+                nb_device = store.render(base, "dcim/devices", objects["dcim/devices"][device_id])
+                nb_device["interfaces"] = []
+                for interface_id in store.filter_ids("dcim/interfaces", {"device_id": [str(device_id)]}):
+                    interface = objects["dcim/interfaces"][interface_id]
+                    nb_interface = store.render(base, "dcim/interfaces", interface)
+                    del nb_interface["device"]
+                    untagged_vlan = interface.get("untagged_vlan")
+                    nb_interface["untagged_vlan"] = render_vlan(untagged_vlan) if untagged_vlan else None
+                    nb_interface["tagged_vlans"] = [render_vlan(x) for x in interface.get("tagged_vlans") or []]
+                    nb_interface["ip_addresses"] = [
+                        {x: objects["ipam/ip-addresses"][y][x] for x in ("id", "address", "last_updated")}
+                        for y in store.filter_ids("ipam/ip-addresses", {"assigned_object_id": [str(interface_id)]})
+                    ]
+                    nb_device["interfaces"].append(nb_interface)
+                device_list.append(nb_device)
+            return self.reply(200, {"data": {"device_list": device_list}})
+
+    def handle_verb(self, verb):
+        url = urlparse(self.path)
+        if url.path.startswith("/_benchmark/"):
+            return self.handle_control(verb, url.path)
+
+        store = self.store
+        if store.latency or store.jitter:
+            time.sleep(store.latency + random.uniform(0, store.jitter))
+        if store.throttle_rate and random.random() < store.throttle_rate:
+            self.read_body()
+            with store.lock:
+                store.requests[(self.command, "throttled")] += 1
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if url.path.rstrip("/") == "/graphql" and verb == "POST":
+            return self.handle_graphql()
+        parts = [x for x in url.path.split("/") if x][1:]
+        if not parts:
+            return self.reply(200, {})
+        endpoint = "/".join(parts[:2])
+        obj_id = int(parts[2]) if len(parts) > 2 else None
+        params = parse_qs(url.query)
+        base = f"http://{self.headers['Host']}"
+        data = self.read_body()
+
+        with store.lock:
+            store.requests[(verb, endpoint)] += 1
+            objects = store.objects[endpoint]
+            if verb == "GET" and obj_id is not None:
+                if obj_id not in objects:
+                    return self.reply(404, {"detail": "Not found."})
+                return self.reply(200, store.render(base, endpoint, objects[obj_id]))
+            if verb == "GET":
+                try:
+                    found = store.filter_ids(endpoint, params)
+                except ValueError as e:
+                    return self.reply(400, {"detail": str(e)})
+                brief = params.get("brief", ["false"])[0].lower() in ("1", "true")
+                fields = params["fields"][0].split(",") if "fields" in params else None
+                limit = min(int(params.get("limit", [50])[0]) or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+                offset = int(params.get("offset", [0])[0])
+                next_url = None
+                if offset + limit < len(found):
+                    query = "&".join(f"{x}={z}" for x, y in params.items() for z in y if x not in ("limit", "offset"))
+                    next_url = f"{base}/api/{endpoint}/?{query}&limit={limit}&offset={offset + limit}"
+                return self.reply(200, {
+                    "count": len(found),
+                    "next": next_url,
+                    "previous": None,
+                    "results": [
+                        store.render(base, endpoint, objects[x], brief, fields) for x in found[offset:offset + limit]
+                    ],
+                })
+            if verb == "POST":
+                items = data if isinstance(data, list) else [data]
+                created = [store.render(base, endpoint, store.write(endpoint, x)) for x in items]
+                return self.reply(201, created if isinstance(data, list) else created[0])
+            if verb == "PATCH":
+                items = data if isinstance(data, list) else [dict(data, id=obj_id)]
+                if any(int(x["id"]) not in objects for x in items):
+                    return self.reply(404, {"detail": "Not found."})
+                updated = [store.render(base, endpoint, store.write(endpoint, x, int(x["id"]))) for x in items]
+                return self.reply(200, updated if isinstance(data, list) else updated[0])
+            if verb == "DELETE":
+                for x in [int(x["id"]) for x in data] if data else [obj_id]:
+                    store.delete(endpoint, x)
+                return self.reply(204)
+
+    def do_GET(self):
+        self.handle_verb("GET")
+
+    def do_POST(self):
+        self.handle_verb("POST")
+
+    def do_PATCH(self):
+        self.handle_verb("PATCH")
+
+    def do_DELETE(self):
+        self.handle_verb("DELETE")
+
+
+class FakeNetBox:
+    def __init__(self, latency=0.0, jitter=0.0, throttle_rate=0.0, host="127.0.0.1", port=0):
+        self.store = FakeNetBoxStore(latency, jitter, throttle_rate)
+        handler = type("Handler", (FakeNetBoxHandler,), {"store": self.store})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def serve_fake_netbox(latency, jitter, throttle_rate, url_queue):
+    fake_nb = FakeNetBox(latency, jitter, throttle_rate)
+    url_queue.put(fake_nb.url)
+    fake_nb.server.serve_forever()
+
+
+def fake_netbox_request(url, path, verb="GET"):
+    request = urllib.request.Request(f"{url}{path}", method=verb)
+    with urllib.request.urlopen(request) as response:
+        body = response.read()
+    return json.loads(body) if body else None
+
+
+SCENARIOS = {
+    "small": {"sites": 5, "devices": 100, "interfaces": 2000},
+    "medium": {"sites": 20, "devices": 1000, "interfaces": 20000},
+    "large": {"sites": 100, "devices": 10000, "interfaces": 200000},
+}
+
+
+def generate_scenario(sites, devices, interfaces, vlans_per_site=10, regions=5, device_types=5, revision=0):
+    objects_data = {
+        "regions": [{"name": f"region-{i}"} for i in range(regions)],
+        "manufacturers": [{"name": "manufacturer-0"}],
+        "device_roles": [{"name": "access"}, {"name": "core"}],
+        "device_types": [
+            {"model": f"model-{i}", "manufacturer": "manufacturer-0"} for i in range(device_types)
+        ],
+        "sites": [
+            {"name": f"site-{i}", "region": f"region-{i % regions}"} for i in range(sites)
+        ],
+        "vlans": [
+            {"vid": 100 + x, "name": f"vlan-{100 + x}", "site": f"site-{i}"}
+            for i in range(sites) for x in range(vlans_per_site)
+        ],
+        "devices": [],
+        "interfaces": [],
+    }
+    interfaces_per_device = max(interfaces // max(devices, 1), 1)
+    for i in range(devices):
+        device_name = f"device-{i}"
+        objects_data["devices"].append({
+            "name": device_name,
+            "device_role": "core" if i % 50 == 0 else "access",
+            "device_type": f"model-{i % device_types}",
+            "site": f"site-{i % sites}",
+        })
+        for x in range(interfaces_per_device):
+            interface_data = {
+                "name": f"GigabitEthernet0/{x}",
+                "device": device_name,
+                "description": f"port {x}",
+                "mode": "access",
+                "untagged_vlan": 100 + x % vlans_per_site,
+            }
+            if x == 0:
+                interface_data["ipv4"] = [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}/32"]
+            # Every 100th interface changes between revisions, a typical incremental delta
+            if revision and (i * interfaces_per_device + x) % 100 == 0:
+                interface_data["description"] = f"port {x} rev {revision}"
+            objects_data["interfaces"].append(interface_data)
+    return objects_data
+
+
+def scenario_records(objects_data):
+    for object_name, objects in objects_data.items():
+        for object_data in objects:
+            yield json.dumps({"object_type": object_name, "data": object_data})
+
+
+def run_phase(phase, url, objects_data, mode, cache_path=None, fingerprint_path=None, use_graphql=False,
+              **sync_kwargs):
+    fake_netbox_request(url, "/_benchmark/reset-stats", "POST")
+    synced = sum(len(x) for x in objects_data.values())
+    id_cache = SqliteIdCache(cache_path) if cache_path else None
+    fingerprints = SqliteFingerprintStore(fingerprint_path) if fingerprint_path else None
+    nb = NetBox(url, "0123456789abcdef0123456789abcdef01234567", id_cache=id_cache, fingerprints=fingerprints,
+        use_graphql=use_graphql,
+    )
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if id_cache:
+        nb.validate_cache(list(objects_data) + ["ip_addresses"])
+    if mode == "bulk":
+        errors = nb.sync_ndjson(scenario_records(objects_data), **sync_kwargs)
+    elif mode == "sharded":
+        # Only the parent process is traced, worker memory is not part of peak MB
+        errors = nb.sync_sharded(objects_data, **sync_kwargs)
+    else:
+        errors = nb.sync(objects_data, **sync_kwargs)
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if id_cache:
+        id_cache.close()
+    if fingerprints:
+        fingerprints.close()
+
+    requests = {f"{x} {y}": z for x, y, z in fake_netbox_request(url, "/_benchmark/stats")}
+    total_requests = sum(requests.values())
+    return {
+        "phase": phase,
+        "mode": mode,
+        "objects": synced,
+        "errors": sum(len(x) for x in errors.values()),
+        "wall_time": round(wall_time, 3),
+        "objects_per_second": round(synced / wall_time, 1) if wall_time else None,
+        "requests": total_requests,
+        "requests_per_object": round(total_requests / synced, 4) if synced else None,
+        "peak_memory_mb": round(peak_memory / 1024 / 1024, 2),
+        "retries": sum(nb.metrics.retries.values()),
+        "requests_by_endpoint": requests,
+    }
+
+
+def run_benchmark(scenario, phases=("full", "incremental", "noop"), mode="bulk", latency=0.0, jitter=0.0,
+                  throttle_rate=0.0, cache_path=None, fingerprint_path=None, use_graphql=False, **sync_kwargs):
+    url_queue = multiprocessing.Queue()
+    # The fake runs in its own process so peak memory and CPU time only reflect the sync client
+    server = multiprocessing.Process(
+        target=serve_fake_netbox, args=(latency, jitter, throttle_rate, url_queue), daemon=True
+    )
+    server.start()
+    url = url_queue.get(timeout=30)
+
+    results = []
+    try:
+        revision = 0
+        for phase in phases:
+            if phase == "incremental":
+                revision += 1
+            elif phase == "full":
+                fake_netbox_request(url, "/_benchmark/reset", "POST")
+                for path in (cache_path, fingerprint_path):
+                    if path and os.path.exists(path):
+                        os.remove(path)
+                revision = 0
+            objects_data = generate_scenario(**scenario, revision=revision)
+            results.append(run_phase(
+                phase, url, objects_data, mode, cache_path, fingerprint_path, use_graphql, **sync_kwargs
+            ))
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark netbox_sync against a local fake NetBox API")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="small")
+    parser.add_argument("--sites", type=int)
+    parser.add_argument("--devices", type=int)
+    parser.add_argument("--interfaces", type=int)
+    parser.add_argument("--phases", default="full,incremental,noop")
+    parser.add_argument("--mode", choices=["bulk", "sync", "sharded"], default="bulk")
+    parser.add_argument("--latency", type=float, default=0.0, help="injected latency per request, in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency per request, in ms")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument("--id-cache", help="persistent ID cache path, kept across phases for incremental runs")
+    parser.add_argument("--fingerprints", help="fingerprint store path, kept across phases to skip unchanged records")
+    parser.add_argument("--graphql", action="store_true", help="read interface trees through GraphQL")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    scenario = dict(SCENARIOS[args.scenario])
+    scenario.update({x: getattr(args, x) for x in ("sites", "devices", "interfaces") if getattr(args, x)})
+    results = run_benchmark(
+        scenario, args.phases.split(","), args.mode, args.latency / 1000, args.jitter / 1000, args.throttle_rate,
+        args.id_cache,
+        args.fingerprints,
+        args.graphql,
+    )
+
+    if args.json:
+        print(json.dumps({"scenario": scenario, "results": results}, indent=4))
+        return
+    print(f"scenario: {scenario}, mode: {args.mode}, latency: {args.latency}ms")
+    print(f"{'phase':<12}{'objects':>10}{'errors':>8}{'wall s':>10}{'obj/s':>10}{'requests':>10}{'req/obj':>10}{'peak MB':>10}")
+    for x in results:
+        print(
+            f"{x['phase']:<12}{x['objects']:>10}{x['errors']:>8}{x['wall_time']:>10}{x['objects_per_second']:>10}"
+            f"{x['requests']:>10}{x['requests_per_object']:>10}{x['peak_memory_mb']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,535 @@
+import asyncio
+import copy
+import hashlib
+import ipaddress
+import itertools
+import json
+import logging
+import multiprocessing
 import operator
+import os
 import pynetbox
+import random
 import re
+import requests
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from collections import Counter, defaultdict, deque, namedtuple
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pynetbox.core.response import Record
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+UNRESOLVED = object()
+
+# Reference fields from fetch_config.json and the object types they point to, "parent" points to its own type
+REFERENCE_TYPES = {
+    "region": "regions",
+    "site": "sites",
+    "location": "locations",
+    "rack": "racks",
+    "tenant": "tenants",
+    "manufacturer": "manufacturers",
+    "platform": "platforms",
+    "device_type": "device_types",
+    "device_role": "device_roles",
+    "device": "devices",
+    "contact": "contacts",
+    "rir": "rirs",
+    "asns": "asns",
+}
+SCOPED_REFERENCE_TYPES = {
+    "group": {"tenants": "tenant_groups", "sites": "site_groups", "contacts": "contact_groups"},
+    "role": {"devices": "device_roles", "contact_assignments": "contact_roles"},
+}
+
+DEVICE_TREE_QUERY = """
+query DeviceTrees($names: [String!]) {
+  device_list($filter) {
+    id name description serial position status face last_updated
+    site { id } location { id } rack { id } tenant { id } platform { id } device_type { id } role { id } tags { id }
+    interfaces {
+      id name label description enabled mgmt_only mtu speed duplex mode type last_updated
+      lag { id } parent { id } tags { id }
+      untagged_vlan { id vid last_updated site { id } }
+      tagged_vlans { id vid last_updated site { id } }
+      ip_addresses { id address last_updated }
+    }
+  }
+}
+"""
+
+DeviceIndexEntry = namedtuple("DeviceIndexEntry", ["id", "site_id", "location_id", "rack_id"])
+PendingWrite = namedtuple(
+    "PendingWrite", ["journal_key", "normal_data", "ip_list", "lookup_clause", "fingerprint", "unchanged_id"]
+)
+
+
+class SqliteIdCache:
+    def __init__(self, path, ttl=86400, type_ttls=None):
+        self.path = path
+        self.ttl = ttl
+        self.type_ttls = type_ttls or dict()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS nb_id_cache ("
+            "object_name TEXT, cache_key TEXT, nb_id INTEGER, last_updated TEXT, cached_at REAL, "
+            "PRIMARY KEY (object_name, cache_key))"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS sync_cursors (object_name TEXT PRIMARY KEY, cursor TEXT)")
+        self.db.commit()
+
+    def load(self, object_name):
+        expire_before = time.time() - self.type_ttls.get(object_name, self.ttl)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT cache_key, nb_id FROM nb_id_cache WHERE object_name = ? AND cached_at >= ?",
+                (object_name, expire_before),
+            ).fetchall()
+        return dict(rows)
+
+    def last_updated(self, object_name):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT nb_id, last_updated FROM nb_id_cache WHERE object_name = ?",
+                (object_name,),
+            ).fetchall()
+        return dict(rows)
+
+    def set(self, object_name, cache_key, nb_id, last_updated=None):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO nb_id_cache VALUES (?, ?, ?, ?, ?)",
+                (object_name, cache_key, nb_id, last_updated, time.time()),
+            )
+            self.db.commit()
+
+    def delete(self, object_name, nb_id):
+        with self.lock:
+            self.db.execute("DELETE FROM nb_id_cache WHERE object_name = ? AND nb_id = ?", (object_name, nb_id))
+            self.db.commit()
+
+    def get_cursor(self, object_name):
+        with self.lock:
+            row = self.db.execute("SELECT cursor FROM sync_cursors WHERE object_name = ?", (object_name,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, object_name, cursor):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO sync_cursors VALUES (?, ?)", (object_name, cursor))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class SqliteFingerprintStore:
+    def __init__(self, path, verify_after=604800):
+        self.path = path
+        self.verify_after = verify_after
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            "object_name TEXT, cache_key TEXT, fingerprint TEXT, nb_id INTEGER, verify_at REAL, "
+            "PRIMARY KEY (object_name, cache_key))"
+        )
+        self.db.commit()
+
+    def load(self, object_name):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT cache_key, fingerprint, nb_id FROM fingerprints WHERE object_name = ? AND verify_at > ?",
+                (object_name, time.time()),
+            ).fetchall()
+        return {x: (y, z) for x, y, z in rows}
+
+    def set_many(self, object_name, rows):
+        now = time.time()
+        # Spread re-verification over time, so records written together are not all re-checked in one run
+        values = [
+            (object_name, x, y, z, now + self.verify_after * random.uniform(0.5, 1)) for x, y, z in rows
+        ]
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)", values)
+            self.db.commit()
+
+    def delete(self, object_name, nb_ids):
+        with self.lock:
+            self.db.executemany(
+                "DELETE FROM fingerprints WHERE object_name = ? AND nb_id = ?", [(object_name, x) for x in nb_ids]
+            )
+            self.db.commit()
+
+    def clear(self, object_name=None):
+        with self.lock:
+            if object_name:
+                self.db.execute("DELETE FROM fingerprints WHERE object_name = ?", (object_name,))
+            else:
+                self.db.execute("DELETE FROM fingerprints")
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class SyncJournal:
+    def __init__(self, path, quarantine_path=None):
+        self.path = path
+        self.quarantine_path = quarantine_path or f"{path}.quarantine.ndjson"
+        self.lock = threading.Lock()
+        self.entries = defaultdict(dict)
+        if os.path.exists(path):
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A run killed mid-write leaves a partial last line
+                        continue
+                    self.entries[entry["object_type"]][entry["key"]] = (entry["cache_key"], entry["id"])
+        self.journal_file = open(path, "a")
+        self.quarantine_file = None
+
+    @staticmethod
+    def input_key(object_data):
+        return hashlib.sha256(json.dumps(object_data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def start(self, resume=False):
+        with self.lock:
+            if not resume:
+                self.entries.clear()
+                self.journal_file.truncate(0)
+            # Quarantined records of the previous run are retried, the file only holds this run's failures
+            if self.quarantine_file:
+                self.quarantine_file.close()
+            self.quarantine_file = open(self.quarantine_path, "w")
+
+    def journaled(self, object_name, object_data):
+        return self.input_key(object_data) in self.entries.get(object_name, {})
+
+    def record(self, object_name, rows):
+        with self.lock:
+            for key, cache_key, nb_id in rows:
+                self.entries[object_name][key] = (cache_key, nb_id)
+                self.journal_file.write(
+                    json.dumps({"object_type": object_name, "key": key, "cache_key": cache_key, "id": nb_id}) + "\n"
+                )
+            # Flushed is enough to survive the process dying, the OS still holds the data
+            self.journal_file.flush()
+
+    def quarantine(self, object_name, objects_data, error):
+        with self.lock:
+            if not self.quarantine_file:
+                self.quarantine_file = open(self.quarantine_path, "w")
+            # Same shape as sync_ndjson input, so the file can be fed back as is
+            for object_data in objects_data:
+                self.quarantine_file.write(
+                    json.dumps({"object_type": object_name, "data": object_data, "error": str(error)}, default=str) + "\n"
+                )
+            self.quarantine_file.flush()
+
+    def close(self):
+        self.journal_file.close()
+        if self.quarantine_file:
+            self.quarantine_file.close()
+
+
+class SyncMetrics:
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.latency = {}
+        self.cache = defaultdict(Counter)
+        self.normalization = defaultdict(Counter)
+        self.retries = Counter()
+        self.fingerprints = defaultdict(Counter)
+
+    def __getstate__(self):
+        return {x: y for x, y in self.__dict__.items() if x != "lock"}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def merge(self, other):
+        with self.lock:
+            self.calls.update(other.calls)
+            self.retries.update(other.retries)
+            for verb, other_histogram in other.latency.items():
+                histogram = self.latency.setdefault(verb, {"buckets": [0] * len(self.latency_buckets), "sum": 0.0, "count": 0})
+                histogram["buckets"] = [x + y for x, y in zip(histogram["buckets"], other_histogram["buckets"])]
+                histogram["sum"] += other_histogram["sum"]
+                histogram["count"] += other_histogram["count"]
+            for name in ("cache", "normalization", "fingerprints"):
+                for key, counter in getattr(other, name).items():
+                    getattr(self, name)[key].update(counter)
+
+    def observe_call(self, object_name, verb, seconds):
+        with self.lock:
+            self.calls[(object_name, verb)] += 1
+            histogram = self.latency.setdefault(verb, {"buckets": [0] * len(self.latency_buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.latency_buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    @contextmanager
+    def timed_call(self, object_name, verb):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_call(object_name, verb, time.perf_counter() - start)
+
+    def count_retry(self, verb, reason):
+        with self.lock:
+            self.retries[(verb, str(reason))] += 1
+
+    def count_cache(self, object_name, hit):
+        with self.lock:
+            self.cache[object_name]["hit" if hit else "miss"] += 1
+
+    def count_fingerprint(self, object_name, hit):
+        with self.lock:
+            self.fingerprints[object_name]["unchanged" if hit else "changed"] += 1
+
+    @contextmanager
+    def timed_normalization(self, fn_name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.normalization[fn_name]["calls"] += 1
+                self.normalization[fn_name]["seconds"] += time.perf_counter() - start
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "api_calls": [{"object_type": x, "verb": y, "count": z} for (x, y), z in sorted(self.calls.items())],
+                "api_latency": {
+                    x: {"buckets": dict(zip(self.latency_buckets, y["buckets"])), "sum": y["sum"], "count": y["count"]}
+                    for x, y in self.latency.items()
+                },
+                "cache": {x: dict(y) for x, y in self.cache.items()},
+                "fingerprints": {x: dict(y) for x, y in self.fingerprints.items()},
+                "normalization": {x: dict(y) for x, y in self.normalization.items()},
+                "retries": [{"verb": x, "reason": y, "count": z} for (x, y), z in sorted(self.retries.items())],
+            }
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP netbox_sync_api_calls_total NetBox API calls by object type and verb.",
+            "# TYPE netbox_sync_api_calls_total counter",
+        ]
+        metrics = self.as_dict()
+        for x in metrics["api_calls"]:
+            lines.append(f'netbox_sync_api_calls_total{{object_type="{x["object_type"]}",verb="{x["verb"]}"}} {x["count"]}')
+        lines += [
+            "# HELP netbox_sync_api_latency_seconds NetBox API call latency by verb.",
+            "# TYPE netbox_sync_api_latency_seconds histogram",
+        ]
+        for verb, histogram in metrics["api_latency"].items():
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'netbox_sync_api_latency_seconds_bucket{{verb="{verb}",le="{bound}"}} {count}')
+            lines.append(f'netbox_sync_api_latency_seconds_bucket{{verb="{verb}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'netbox_sync_api_latency_seconds_sum{{verb="{verb}"}} {histogram["sum"]}')
+            lines.append(f'netbox_sync_api_latency_seconds_count{{verb="{verb}"}} {histogram["count"]}')
+        lines += [
+            "# HELP netbox_sync_cache_lookups_total nb_id_cache lookups by object type and result.",
+            "# TYPE netbox_sync_cache_lookups_total counter",
+        ]
+        for object_name, counts in sorted(metrics["cache"].items()):
+            for result, count in sorted(counts.items()):
+                lines.append(f'netbox_sync_cache_lookups_total{{object_type="{object_name}",result="{result}"}} {count}')
+        lines += [
+            "# HELP netbox_sync_fingerprint_checks_total Source records checked against the fingerprint store.",
+            "# TYPE netbox_sync_fingerprint_checks_total counter",
+        ]
+        for object_name, counts in sorted(metrics["fingerprints"].items()):
+            for result, count in sorted(counts.items()):
+                lines.append(f'netbox_sync_fingerprint_checks_total{{object_type="{object_name}",result="{result}"}} {count}')
+        lines += [
+            "# HELP netbox_sync_normalization_seconds_total Time spent in normalization functions.",
+            "# TYPE netbox_sync_normalization_seconds_total counter",
+        ]
+        for fn_name, counts in sorted(metrics["normalization"].items()):
+            lines.append(f'netbox_sync_normalization_seconds_total{{function="{fn_name}"}} {counts["seconds"]}')
+        lines += [
+            "# HELP netbox_sync_normalization_calls_total Calls to normalization functions.",
+            "# TYPE netbox_sync_normalization_calls_total counter",
+        ]
+        for fn_name, counts in sorted(metrics["normalization"].items()):
+            lines.append(f'netbox_sync_normalization_calls_total{{function="{fn_name}"}} {counts["calls"]}')
+        lines += [
+            "# HELP netbox_sync_retries_total Retried NetBox API calls by verb and reason.",
+            "# TYPE netbox_sync_retries_total counter",
+        ]
+        for x in metrics["retries"]:
+            lines.append(f'netbox_sync_retries_total{{verb="{x["verb"]}",reason="{x["reason"]}"}} {x["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+class AdaptiveLimiter:
+    def __init__(self, max_limit=32, min_limit=1, initial_limit=None, latency_tolerance=2.0, backoff_ratio=0.7):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        self.in_flight = 0
+        self.baselines = dict()
+        self.last_backoff = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, key, latency, overloaded=False):
+        with self.condition:
+            self.in_flight -= 1
+            baseline = self.baselines.get(key)
+            now = time.monotonic()
+            if overloaded or (baseline and latency > baseline * self.latency_tolerance):
+                # Concurrent slow responses are one signal, back off at most once per round trip
+                if now - self.last_backoff > latency:
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self.last_backoff = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            if not overloaded:
+                # Tracks the fastest recent latency, drifting up so a slower server is not penalized forever
+                if baseline is None or latency < baseline:
+                    self.baselines[key] = latency
+                else:
+                    self.baselines[key] = baseline + (latency - baseline) * 0.01
+            self.condition.notify_all()
+
+
+class NetBoxHTTPAdapter(HTTPAdapter):
+    retry_statuses = {429, 500, 502, 503, 504}
+    overload_statuses = {429, 503}
+    # Bulk PATCHes set absolute field values, replaying them is safe
+    idempotent_verbs = {"GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE"}
+
+    def __init__(self, pool_size=32, retries=5, backoff=0.5, backoff_max=60, limiter=None, metrics=None):
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.limiter = limiter
+        self.metrics = metrics
+
+    @staticmethod
+    def retry_delay(retry_after, attempt, backoff, backoff_max):
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0), backoff_max)
+            except ValueError:
+                try:
+                    return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), backoff_max)
+                except (TypeError, ValueError):
+                    pass
+        # Full jitter, so throttled workers do not come back in lockstep
+        return random.uniform(0, min(backoff_max, backoff * 2 ** attempt))
+
+    def send(self, request, **kwargs):
+        limiter_key = (request.method, re.sub(r"/\d+/", "/{id}/", request.path_url.split("?")[0]))
+        for attempt in itertools.count():
+            response, error = None, None
+            if self.limiter:
+                self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                if self.limiter:
+                    overloaded = response is None or response.status_code in self.overload_statuses
+                    self.limiter.release(limiter_key, time.monotonic() - start, overloaded)
+
+            status = error.__class__.__name__ if error else response.status_code
+            # A 429 means the request was rejected before it was processed, even a POST can be replayed
+            retryable = status == 429 or (
+                request.method in self.idempotent_verbs and (error or status in self.retry_statuses)
+            )
+            if not retryable or attempt >= self.retries:
+                if error:
+                    raise error
+                return response
+
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            delay = self.retry_delay(retry_after, attempt, self.backoff, self.backoff_max)
+            if response is not None:
+                response.close()
+            if self.metrics:
+                self.metrics.count_retry(request.method, status)
+            logger.warning(
+                "RETRY: %s %s, %s, attempt %s in %.2fs", request.method, request.path_url, status, attempt + 1, delay,
+                extra={"action": "retry"},
+            )
+            time.sleep(delay)
 
 
 class NetBox:
-    def __init__(self, url, token):
+    def __init__(self, url, token, bulk_chunk_size=500, id_cache=None, auto_create_tags=False, pool_size=32,
+                 retries=5, retry_backoff=0.5, adaptive_concurrency=True, fingerprints=None, fetch_config=None,
+                 use_graphql=False, journal=None):
+        self.url = url
+        self.token = token
+        # Settings a shard worker process needs to rebuild an equivalent client
+        self.shard_kwargs = {
+            "bulk_chunk_size": bulk_chunk_size,
+            "auto_create_tags": auto_create_tags,
+            "pool_size": pool_size,
+            "retries": retries,
+            "retry_backoff": retry_backoff,
+            "adaptive_concurrency": adaptive_concurrency,
+            "fetch_config": fetch_config,
+            "use_graphql": use_graphql,
+        }
         self.nb = pynetbox.api(
             url,
             token=token
         )
 
         self.nb.http_session.verify = False
+        self.metrics = SyncMetrics()
+        self.limiter = AdaptiveLimiter(max_limit=pool_size) if adaptive_concurrency else None
+        self.http_adapter = NetBoxHTTPAdapter(
+            pool_size=pool_size, retries=retries, backoff=retry_backoff, limiter=self.limiter, metrics=self.metrics
+        )
+        self.nb.http_session.mount("http://", self.http_adapter)
+        self.nb.http_session.mount("https://", self.http_adapter)
 
         self.nb_objects = {
             "tags": {
@@ -32,7 +551,19 @@ class NetBox:
                 "lookup_fields": [
                     "name"
                 ],
-                "normalization_fn": self.region_normalization
+                "self_refs": [
+                    "parent"
+                ]
+            },
+            "rirs": {
+                "path": "ipam.rirs",
+                "slug_generate": True,
+                "required_fields": [
+                    "name"
+                ],
+                "lookup_fields": [
+                    "name"
+                ],
             },
             "tenant_groups": {
                 "path": "tenancy.tenant_groups",
@@ -43,18 +574,36 @@ class NetBox:
                 "lookup_fields": [
                     "name"
                 ],
-                "normalization_fn": self.tenant_group_normalization
+                "self_refs": [
+                    "parent"
+                ]
             },
             "tenants": {
                 "path": "tenancy.tenants",
+                "depends_on": [
+                    "tenant_groups",
+                ],
                 "slug_generate": True,
                 "required_fields": [
                     "name"
                 ],
                 "lookup_fields": [
                     "name"
+                ]
+            },
+            "asns": {
+                "path": "ipam.asns",
+                "depends_on": [
+                    "rirs",
+                    "tenants",
+                ],
+                "required_fields": [
+                    "asn",
+                    "rir"
+                ],
+                "lookup_fields": [
+                    "asn"
                 ],
-                "normalization_fn": self.tenant_normalization
             },
             "site_groups": {
                 "path": "dcim.site_groups",
@@ -65,21 +614,32 @@ class NetBox:
                 "lookup_fields": [
                     "name"
                 ],
-                "normalization_fn": self.site_group_normalization
+                "self_refs": [
+                    "parent"
+                ]
             },
             "sites": {
                 "path": "dcim.sites",
+                "depends_on": [
+                    "site_groups",
+                    "regions",
+                    "tenants",
+                ],
                 "slug_generate": True,
                 "required_fields": [
                     "name"
                 ],
                 "lookup_fields": [
                     "name"
-                ],
-                "normalization_fn": self.site_normalization
+                ]
             },
             "locations": {
                 "path": "dcim.locations",
+                "shard_by": "site",
+                "depends_on": [
+                    "sites",
+                    "tenants",
+                ],
                 "slug_generate": True,
                 "required_fields": [
                     "name",
@@ -89,10 +649,21 @@ class NetBox:
                     "name",
                     "site_id"
                 ],
-                "normalization_fn": self.location_normalization
+                "cache_lookups": [
+                    ["name"]
+                ],
+                "self_refs": [
+                    "parent"
+                ]
             },
             "racks": {
                 "path": "dcim.racks",
+                "shard_by": "site",
+                "depends_on": [
+                    "locations",
+                    "sites",
+                    "tenants",
+                ],
                 "required_fields": [
                     "name",
                     "site"
@@ -101,7 +672,9 @@ class NetBox:
                     "name",
                     "site_id"
                 ],
-                "normalization_fn": self.rack_normalization
+                "cache_lookups": [
+                    ["name"]
+                ]
             },
             "contact_roles": {
                 "path": "tenancy.contact_roles",
@@ -122,20 +695,32 @@ class NetBox:
                 "lookup_fields": [
                     "name"
                 ],
-                "normalization_fn": self.contact_group_normalization
+                "self_refs": [
+                    "parent"
+                ]
             },
             "contacts": {
                 "path": "tenancy.contacts",
+                "depends_on": [
+                    "contact_groups",
+                ],
                 "required_fields": [
                     "name"
                 ],
                 "lookup_fields": [
                     "name"
-                ],
-                "normalization_fn": self.contact_normalization
+                ]
             },
             "contact_assignments": {
                 "path": "tenancy.contact_assignments",
+                "depends_on": [
+                    "contacts",
+                    "contact_roles",
+                    "sites",
+                    "locations",
+                    "racks",
+                    "devices",
+                ],
                 "required_fields": [
                     "content_type",
                     "object_id",
@@ -172,17 +757,22 @@ class NetBox:
             },
             "platforms": {
                 "path": "dcim.platforms",
+                "depends_on": [
+                    "manufacturers",
+                ],
                 "slug_generate": True,
                 "required_fields": [
                     "name"
                 ],
                 "lookup_fields": [
                     "name"
-                ],
-                "normalization_fn": self.platform_normalization
+                ]
             },
             "device_types": {
                 "path": "dcim.device_types",
+                "depends_on": [
+                    "manufacturers",
+                ],
                 "slug_generate": True,
                 "required_fields": [
                     "model",
@@ -192,10 +782,16 @@ class NetBox:
                     "model",
                     "manufacturer_id"
                 ],
-                "normalization_fn": self.device_type_normalization
+                "cache_lookups": [
+                    ["model"]
+                ]
             },
             "vlans": {
                 "path": "ipam.vlans",
+                "shard_by": "site",
+                "depends_on": [
+                    "sites",
+                ],
                 "required_fields": [
                     "vid",
                     "name",
@@ -205,11 +801,20 @@ class NetBox:
                     "vid",
                     "site_id"
                 ],
-                "normalization_fn": self.vlan_normalization,
                 "create_if_absent": self.create_absent_vlan,
             },
             "devices": {
                 "path": "dcim.devices",
+                "shard_by": "site",
+                "depends_on": [
+                    "device_roles",
+                    "device_types",
+                    "platforms",
+                    "sites",
+                    "locations",
+                    "tenants",
+                    "racks",
+                ],
                 "required_fields": [
                     "name",
                     "device_role",
@@ -219,10 +824,17 @@ class NetBox:
                 "lookup_fields": [
                     "name",
                 ],
-                "normalization_fn": self.device_normalization
+                # Older NetBox APIs name the role field device_role, fetch_config.json uses role
+                "references": {
+                    "device_role": "name",
+                },
             },
             "inventory_items": {
                 "path": "dcim.inventory-items",
+                "shard_by": "device",
+                "depends_on": [
+                    "devices",
+                ],
                 "required_fields": [
                     "device",
                     "name",
@@ -232,11 +844,15 @@ class NetBox:
                     "device_id",
                     "name",
                     "serial",
-                ],
-                "normalization_fn": self.inventory_normalization
+                ]
             },
             "interfaces": {
                 "path": "dcim.interfaces",
+                "shard_by": "device",
+                "depends_on": [
+                    "devices",
+                    "vlans",
+                ],
                 "required_fields": [
                     "name",
                     "device",
@@ -245,11 +861,18 @@ class NetBox:
                     "name",
                     "device_id",
                 ],
+                "self_refs": [
+                    "lag",
+                    "parent",
+                ],
                 "normalization_fn": self.interface_normalization,
                 "create_if_absent": self.create_absent_interface,
             },
             "ip_addresses": {
                 "path": "ipam.ip-addresses",
+                "depends_on": [
+                    "interfaces",
+                ],
                 "required_fields": [
                     "address",
                 ],
@@ -268,10 +891,47 @@ class NetBox:
             }
         }
 
+        if not isinstance(fetch_config, dict):
+            with open(fetch_config or os.path.join(os.path.dirname(os.path.abspath(__file__)), "fetch_config.json")) as f:
+                fetch_config = json.load(f)
+        self.resolvers = self.compile_resolvers(fetch_config)
+
         self.nb_id_cache = {x: {} for x in self.nb_objects.keys()}
+        self.touched_ids = {x: set() for x in self.nb_objects.keys()}
+        # Records that failed to sync were never touched, pruning their type would delete their objects
+        self.failed_counts = Counter()
+        self.fingerprints = fingerprints
+        self.journal = journal
+        self.fingerprint_cache = dict()
+        self.verify_fingerprints = False
+        self.use_graphql = use_graphql
+        self.graphql_url = self.nb.base_url.rsplit("/api", 1)[0] + "/graphql/"
+        # NetBox 4.0-4.2 filter syntax, later releases take {name: {in_list: $names}}
+        self.graphql_device_filter = "filters: {name: $names}"
+        self.graphql_batch_size = 50
+        self.loaded_device_trees = set()
+        # Records read through GraphQL, handed out once to diff against instead of re-fetching them;
+        # IPs are keyed by address, the others by ID
+        self.tree_snapshot = {"devices": {}, "interfaces": {}, "ip_addresses": {}}
+        self.device_index = dict()
+        self.id_cache = id_cache
+        if self.id_cache:
+            for object_name in self.nb_objects:
+                # Only NetBox hands out positive IDs, anything else was planned and never created
+                self.nb_id_cache[object_name].update({x: y for x, y in self.id_cache.load(object_name).items() if y > 0})
 
-        self.interface_ip_list = []
+        self.cache_lock = threading.RLock()
+        # Held across API calls, so never taken by the event loop thread, unlike cache_lock
+        self.create_locks = defaultdict(threading.Lock)
+        self.tags_lock = threading.Lock()
+        self.thread_state = threading.local()
         self.skip_update_ip = False
+        self.tags_loaded = False
+        self.auto_create_tags = auto_create_tags
+        self.bulk_chunk_size = bulk_chunk_size
+        self.lookup_chunk_size = 100
+        self.page_size = 1000
+        self.page_workers = 4
 
     @staticmethod
     def nb_slug(raw_name):
@@ -281,6 +941,62 @@ class NetBox:
         raw_name = raw_name.strip('-')
         return raw_name
 
+    @staticmethod
+    def nb_cache_key(lookup_clause):
+        return "__".join([f"{x}={y}" for x, y in sorted(lookup_clause.items())])
+
+    @staticmethod
+    def nb_record_value(nb_record, field):
+        if isinstance(nb_record, dict):
+            get_value = dict.get
+        else:
+            def get_value(record, key):
+                return getattr(record, key, None)
+        if field.endswith("_id") and field != "object_id":
+            nested = get_value(nb_record, field[:-3])
+            return nested.get("id") if isinstance(nested, dict) else getattr(nested, "id", nested)
+        return get_value(nb_record, field)
+
+    @staticmethod
+    def nb_chunks(items, chunk_size):
+        for i in range(0, len(items), chunk_size):
+            yield items[i:i + chunk_size]
+
+    @staticmethod
+    def nb_compare_value(value):
+        if isinstance(value, dict):
+            value = value.get("id", value.get("value", value))
+        if isinstance(value, list):
+            return sorted(str(NetBox.nb_compare_value(x)) for x in value)
+        if value is None or value == "":
+            return None
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    @staticmethod
+    def nb_equal(value, nb_value):
+        value, nb_value = NetBox.nb_compare_value(value), NetBox.nb_compare_value(nb_value)
+        if value == nb_value:
+            return True
+        # A number only matches its own string form, two strings are never compared as numbers ("007" != "7")
+        for number, text in ((value, nb_value), (nb_value, value)):
+            if isinstance(number, (int, float)) and not isinstance(number, bool) and isinstance(text, str):
+                return text in (str(number), str(float(number)))
+        return False
+
+    @staticmethod
+    def nb_diff(nb_record, object_data):
+        nb_data = nb_record if isinstance(nb_record, dict) else nb_record.serialize()
+        object_diff = dict()
+        for field, value in object_data.items():
+            # Keys unknown to NetBox are not record fields
+            if field not in nb_data:
+                continue
+            if not NetBox.nb_equal(value, nb_data[field]):
+                object_diff[field] = value
+        return object_diff
+
     @staticmethod
     def nb_interface_type(interface_name: str):
         if "." in interface_name:
@@ -298,136 +1014,69 @@ class NetBox:
         else:
             return "other"
 
-    def region_normalization(self, raw_data):
-        region_parent = raw_data.get("parent")
-        if region_parent:
-            raw_data["parent"] = self.get_nb_id("regions", {"name": region_parent})
-        return raw_data
-
-    def tenant_group_normalization(self, raw_data):
-        tenant_group_parent = raw_data.get("parent")
-        if tenant_group_parent:
-            raw_data["parent"] = self.get_nb_id("tenant_groups", {"name": tenant_group_parent})
-        return raw_data
-
-    def tenant_normalization(self, raw_data):
-        tenant_group = raw_data.get("group")
-        if tenant_group:
-            raw_data["group"] = self.get_nb_id("tenant_groups", {"name": tenant_group})
-        return raw_data
-
-    def site_group_normalization(self, raw_data):
-        site_parent = raw_data.get("parent")
-        if site_parent:
-            raw_data["parent"] = self.get_nb_id("site_groups", {"name": site_parent})
-        return raw_data
+    @staticmethod
+    def reference_type(object_name, field):
+        if field == "parent":
+            return object_name
+        if field in SCOPED_REFERENCE_TYPES:
+            return SCOPED_REFERENCE_TYPES[field].get(object_name)
+        return REFERENCE_TYPES.get(field)
 
-    def site_normalization(self, raw_data):
-        site_group = raw_data.get("group")
-        if site_group:
-            raw_data["group"] = self.get_nb_id("site_groups", {"name": site_group})
-        site_region = raw_data.get("region")
-        if site_region:
-            raw_data["region"] = self.get_nb_id("regions", {"name": site_region})
-        site_tenant = raw_data.get("tenant")
-        if site_tenant:
-            raw_data["tenant"] = self.get_nb_id("tenants", {"name": site_tenant})
-        return raw_data
+    def compile_resolvers(self, fetch_config):
+        resolvers = dict()
+        for object_name, object_conf in self.nb_objects.items():
+            field_specs = {**fetch_config.get(object_name, {}), **object_conf.get("references", {})}
+            resolver = []
+            for field, spec in field_specs.items():
+                many = isinstance(spec, list)
+                key_field = spec[0] if many else spec
+                target = self.reference_type(object_name, field)
+                # Tags have their own preload and auto-create path, "value" marks a choice field
+                if field == "tags" or key_field in ("", "value") or target not in self.nb_objects:
+                    continue
+                resolver.append((field, target, key_field, many))
+            resolvers[object_name] = tuple(resolver)
 
-    def location_normalization(self, raw_data):
-        location_parent = raw_data.get("parent")
-        if location_parent:
-            raw_data["parent"] = self.get_nb_id("locations", {"name": location_parent})
-        location_site = raw_data.get("site")
-        if location_site:
-            raw_data["site"] = self.get_nb_id("sites", {"name": location_site})
-        location_tenant = raw_data.get("tenant")
-        if location_tenant:
-            raw_data["tenant"] = self.get_nb_id("tenants", {"name": location_tenant})
-        return raw_data
+            targets = {x[1] for x in resolver}
+            object_conf["depends_on"] = sorted(set(object_conf.get("depends_on", [])) | targets - {object_name})
+            if object_name in targets:
+                self_refs = object_conf.setdefault("self_refs", [])
+                self_refs += [x[0] for x in resolver if x[1] == object_name and x[0] not in self_refs]
+        return resolvers
 
-    def rack_normalization(self, raw_data):
-        rack_location = raw_data.get("location")
-        if rack_location:
-            raw_data["location"] = self.get_nb_id("locations", {"name": rack_location})
-        rack_site = raw_data.get("site")
-        if rack_site:
-            raw_data["site"] = self.get_nb_id("sites", {"name": rack_site})
-        rack_tenant = raw_data.get("tenant")
-        if rack_tenant:
-            raw_data["tenant"] = self.get_nb_id("tenants", {"name": rack_tenant})
-        return raw_data
-
-    def contact_group_normalization(self, raw_data):
-        region_parent = raw_data.get("parent")
-        if region_parent:
-            raw_data["parent"] = self.get_nb_id("contact_groups", {"name": region_parent})
+    def resolve_fields(self, object_name, raw_data):
+        for field, target, key_field, many in self.resolvers[object_name]:
+            value = raw_data.get(field)
+            if not value:
+                continue
+            if many:
+                raw_data[field] = [self.get_nb_id(target, {key_field: x}) for x in value]
+            else:
+                raw_data[field] = self.get_nb_id(target, {key_field: value})
         return raw_data
 
-    def contact_normalization(self, raw_data):
-        contact_group = raw_data.get("group")
-        if contact_group:
-            raw_data["group"] = self.get_nb_id("contact_groups", {"name": contact_group})
-        return raw_data
+    def resolver_references(self, object_name, objects_data):
+        references = set()
+        for field, target, key_field, many in self.resolvers[object_name]:
+            for object_data in objects_data:
+                value = object_data.get(field)
+                for x in (value if many else [value]) if value else []:
+                    if not self.nb_id_cache[target].get(self.nb_cache_key({key_field: x})):
+                        references.add((target, ((key_field, x),)))
+        return references
 
     def contact_assignment_normalization(self, raw_data):
-        contact = raw_data.get("contact")
-        if contact:
-            raw_data["contact"] = self.get_nb_id("contacts", {"name": contact})
-        contact_role = raw_data.get("role")
-        if contact_role:
-            raw_data["role"] = self.get_nb_id("contact_roles", {"name": contact_role})
         object_id = raw_data.get("object_id")
         content_type = raw_data.get("content_type")
         if object_id and content_type:
             raw_data["object_id"] = self.get_nb_id(f"{content_type.split('.')[-1]}s", {"name": object_id})  # !!!!!
         return raw_data
 
-    def platform_normalization(self, raw_data):
-        platform_manufacturer = raw_data.get("manufacturer")
-        if platform_manufacturer:
-            raw_data["manufacturer"] = self.get_nb_id("manufacturers", {"name": platform_manufacturer})
-        return raw_data
-
-    def device_type_normalization(self, raw_data):
-        device_type_manufacturer = raw_data.get("manufacturer")
-        if device_type_manufacturer:
-            raw_data["manufacturer"] = self.get_nb_id("manufacturers", {"name": device_type_manufacturer})
-        return raw_data
-
-    def vlan_normalization(self, raw_data):
-        vlan_site = raw_data.get("site")
-        if vlan_site:
-            raw_data["site"] = self.get_nb_id("sites", {"name": vlan_site})
-        return raw_data
-
-    def device_normalization(self, raw_data):
-        device_role = raw_data.get("device_role")
-        if device_role:
-            raw_data["device_role"] = self.get_nb_id("device_roles", {"name": device_role})
-        device_type = raw_data.get("device_type")
-        if device_type:
-            raw_data["device_type"] = self.get_nb_id("device_types", {"model": device_type})
-        platform = raw_data.get("platform")
-        if platform:
-            raw_data["platform"] = self.get_nb_id("platforms", {"name": platform})
-        device_site = raw_data.get("site")
-        if device_site:
-            raw_data["site"] = self.get_nb_id("sites", {"name": device_site})
-        device_location = raw_data.get("location")
-        if device_location:
-            raw_data["location"] = self.get_nb_id("locations", {"name": device_location})
-        device_tenant = raw_data.get("tenant")
-        if device_tenant:
-            raw_data["tenant"] = self.get_nb_id("tenants", {"name": device_tenant})
-        device_rack = raw_data.get("rack")
-        if device_rack:
-            raw_data["rack"] = self.get_nb_id("racks", {"name": device_rack})
-        return raw_data
-
     def interface_normalization(self, raw_data):
         device = raw_data["device"]
-        device_id = self.get_nb_id("devices", {"name": device})
+        # Resolved through the device index, a cached ID of a deleted device is caught before anything is written
+        device_entry = self.get_device(device)
+        device_id = device_entry.id if device_entry else UNRESOLVED
         raw_data["device"] = device_id
         raw_data["type"] = self.nb_interface_type(raw_data["name"])
 
@@ -447,10 +1096,7 @@ class NetBox:
         if mode and mode in ["access", "tagged"]:
             raw_data["mode"] = mode
 
-            site_id = self.nb_id_cache["sites"].get(f"device={device}")
-            if not site_id:
-                site_id = self.get_object("devices", {"name": device}).site.id
-                self.nb_id_cache["sites"][f"device={device}"] = site_id
+            site_id = device_entry.site_id if device_entry else UNRESOLVED
 
             tagged_vlans = raw_data.get("tagged_vlans")
             if tagged_vlans:
@@ -461,28 +1107,21 @@ class NetBox:
             if untagged_vlan:
                 raw_data["untagged_vlan"] = self.get_nb_id("vlans", {"site_id": site_id, "vid": untagged_vlan})
 
-        ipv4_addresses = raw_data.get("ipv4")
-        ipv6_addresses = raw_data.get("ipv6")
-        if ipv4_addresses:
-            self.interface_ip_list += ipv4_addresses
-        if ipv6_addresses:
-            self.interface_ip_list += ipv6_addresses
-
         return raw_data
 
-    def inventory_normalization(self, raw_data):
-        raw_data["device"] = self.get_nb_id("devices", {"name": raw_data["device"]})
-        return raw_data
-
-    def normalization(self, object_name, raw_data):
-        object_conf = self.nb_objects[object_name]
-
-        required_fields = object_conf["required_fields"]
+    def validate(self, object_name, raw_data):
+        if object_name not in self.nb_objects:
+            raise Exception(f"Unknown object type: {object_name}")
+        required_fields = self.nb_objects[object_name]["required_fields"]
         object_fields = raw_data.keys()
         required_check = list(set(required_fields) - set(object_fields))
         if required_check:
             raise Exception(f"Required fields: {required_check} omitted in {raw_data}")
 
+    def normalization(self, object_name, raw_data):
+        object_conf = self.nb_objects[object_name]
+        self.validate(object_name, raw_data)
+
         object_slug = object_conf.get("slug_generate")
         if object_slug:
             item_name = raw_data.get("name")
@@ -494,13 +1133,21 @@ class NetBox:
             else:
                 raise Exception(f"Name is not defined for slug generation in {raw_data}")
 
+        if self.resolvers[object_name]:
+            with self.metrics.timed_normalization(f"{object_name}_references"):
+                raw_data = self.resolve_fields(object_name, raw_data)
+
         normalization_fn = object_conf.get("normalization_fn")
         if callable(normalization_fn):
-            raw_data = normalization_fn(raw_data)
+            with self.metrics.timed_normalization(normalization_fn.__name__):
+                raw_data = normalization_fn(raw_data)
 
         tags = raw_data.get("tags")
         if tags:
-            raw_data["tags"] = [self.get_object("tags", {"name": x}).id for x in tags]
+            self.load_tags()
+            if self.auto_create_tags and getattr(self.thread_state, "pending_refs", None) is None:
+                self.ensure_tags(tags)
+            raw_data["tags"] = [self.get_nb_id("tags", {"name": x}) for x in tags]
 
         return raw_data
 
@@ -515,69 +1162,922 @@ class NetBox:
                 lookup_clause[lookup_field] = object_data[lookup_field]
         return lookup_clause
 
-    def create_update_object(self, object_name, object_data, skip_if_exist=False):
+    @staticmethod
+    def pop_interface_ips(object_name, normal_data):
+        if object_name != "interfaces":
+            return []
+        return (normal_data.pop("ipv4", None) or []) + (normal_data.pop("ipv6", None) or [])
+
+    @staticmethod
+    def nb_ip_key(address):
+        try:
+            return ipaddress.ip_interface(address).with_prefixlen
+        except ValueError:
+            return address
+
+    def sync_interface_ips(self, interface_ips):
+        nb_ips = dict()
+        addresses = sorted({self.nb_ip_key(y) for _, y in interface_ips})
+        if self.tree_snapshot["ip_addresses"]:
+            with self.cache_lock:
+                snapshot = self.tree_snapshot["ip_addresses"]
+                nb_ips.update({x: snapshot.pop(x) for x in addresses if x in snapshot})
+            addresses = [x for x in addresses if x not in nb_ips]
+        for chunk in self.nb_chunks(addresses, self.lookup_chunk_size):
+            ip_fields = {"id", "address", "last_updated", "assigned_object_type", "assigned_object_id"}
+            for nb_ip in self.filter_raw("ip_addresses", {"address": chunk}, ip_fields):
+                nb_ips.setdefault(self.nb_ip_key(nb_ip["address"]), nb_ip)
+
+        # An address listed on several interfaces ends up on the last one, as sequential assignment would
+        ip_assignments = {self.nb_ip_key(y): (x, y) for x, y in interface_ips}
+        create_list, update_list = [], []
+        for ip_key, (interface_id, address) in ip_assignments.items():
+            nb_ip = nb_ips.get(ip_key)
+            if not nb_ip:
+                create_list.append({
+                    "address": address,
+                    "assigned_object_type": "dcim.interface",
+                    "assigned_object_id": interface_id,
+                })
+                continue
+            self.cache_nb_id("ip_addresses", f"address={address}", nb_ip["id"], nb_ip.get("last_updated"))
+            self.mark_touched("ip_addresses", [nb_ip["id"]])
+            if self.skip_update_ip:
+                continue
+            if nb_ip.get("assigned_object_type") != "dcim.interface" or nb_ip.get("assigned_object_id") != interface_id:
+                update_list.append({
+                    "id": nb_ip["id"],
+                    "assigned_object_type": "dcim.interface",
+                    "assigned_object_id": interface_id,
+                })
+
+        for chunk in self.nb_chunks(create_list, self.bulk_chunk_size):
+            for nb_ip in self.create_object("ip_addresses", chunk):
+                self.cache_nb_id("ip_addresses", f"address={nb_ip.address}", nb_ip.id, getattr(nb_ip, "last_updated", None))
+                self.mark_touched("ip_addresses", [nb_ip.id])
+            logger.info("BULK CREATE: ip_addresses, %s objects", len(chunk), extra={"action": "create", "object_type": "ip_addresses"})
+        for chunk in self.nb_chunks(update_list, self.bulk_chunk_size):
+            for nb_ip in self.update_objects("ip_addresses", chunk):
+                self.cache_nb_id("ip_addresses", f"address={nb_ip.address}", nb_ip.id, getattr(nb_ip, "last_updated", None))
+            logger.info("BULK UPDATE: ip_addresses, %s objects", len(chunk), extra={"action": "update", "object_type": "ip_addresses"})
+
+    def prepare_write(self, object_name, object_data):
+        journal_key = self.journal.input_key(object_data) if self.journal else None
         normal_data = self.normalization(object_name, object_data)
+        ip_list = self.pop_interface_ips(object_name, normal_data)
         lookup_clause = self.lookup(object_name, normal_data)
-        nb_object = self.get_object(object_name, lookup_clause)
-
-        if nb_object:
-            if skip_if_exist:
-                print(f"SKIPPING UPDATE {object_name}, {object_data=}, reason: {skip_if_exist=}")
-            nb_object.update(normal_data)
-            nb_object.save()
-            print(f"UPDATE: {object_name}, {normal_data}")
+        fingerprint = self.fingerprint(lookup_clause, normal_data, ip_list)
+        nb_id = self.unchanged_nb_id(object_name, lookup_clause, fingerprint)
+        if nb_id:
+            self.skip_unchanged(object_name, lookup_clause, normal_data, nb_id)
+            self.journal_results(object_name, [(journal_key, self.nb_cache_key(lookup_clause), nb_id)])
+        return PendingWrite(journal_key, normal_data, ip_list, lookup_clause, fingerprint, nb_id)
+
+    def finish_write(self, object_name, pending, nb_object):
+        if not nb_object:
+            return
+        cache_key = self.nb_cache_key(pending.lookup_clause)
+        self.mark_touched(object_name, [nb_object.id])
+        self.cache_nb_id(object_name, cache_key, nb_object.id, getattr(nb_object, "last_updated", None))
+        if pending.ip_list:
+            self.sync_interface_ips([(nb_object.id, x) for x in pending.ip_list])
+        if object_name == "devices":
+            self.index_device(nb_object)
+        self.store_fingerprints(object_name, [(cache_key, pending.fingerprint, nb_object.id)])
+        self.journal_results(object_name, [(pending.journal_key, cache_key, nb_object.id)])
+
+    def create_update_object(self, object_name, object_data, skip_if_exist=False):
+        pending = self.prepare_write(object_name, object_data)
+        normal_data = pending.normal_data
+        if pending.unchanged_id:
+            return self.nb_record(object_name, {**normal_data, "id": pending.unchanged_id})
+        nb_object = self.get_object(object_name, pending.lookup_clause)
+
+        if nb_object and skip_if_exist:
+            logger.info("SKIPPING UPDATE: %s, %s", object_name, object_data, extra={"action": "skip", "object_type": object_name})
+        elif nb_object:
+            object_diff = self.nb_diff(nb_object, normal_data)
+            if object_diff:
+                nb_object = self.update_objects(object_name, [{**object_diff, "id": nb_object.id}])[0]
+                logger.info("UPDATE: %s, %s", object_name, object_diff, extra={"action": "update", "object_type": object_name})
         else:
             nb_object = self.create_object(object_name, normal_data)
-            print(f"CREATE: {object_name}, {normal_data}")
-
-        if object_name == "interfaces" and self.interface_ip_list:
-            for ip_address in self.interface_ip_list:
-                self.create_update_object(
-                    object_name="ip_addresses",
-                    object_data={
-                        "address": ip_address,
-                        "assigned_object_type": "dcim.interface",
-                        "assigned_object_id": nb_object.id,
-                    },
-                    skip_if_exist=self.skip_update_ip,
-                )
-            self.interface_ip_list = []
+            logger.info("CREATE: %s, %s", object_name, normal_data, extra={"action": "create", "object_type": object_name})
 
+        self.finish_write(object_name, pending, nb_object)
         return nb_object
 
+    def cache_nb_id(self, object_name, cache_key, nb_id, last_updated=None):
+        with self.cache_lock:
+            self.nb_id_cache[object_name][cache_key] = nb_id
+            if self.id_cache:
+                self.id_cache.set(object_name, cache_key, nb_id, last_updated)
+
+    def invalidate_nb_id(self, object_name, nb_id):
+        self.invalidate_nb_ids(object_name, [nb_id])
+
+    def invalidate_nb_ids(self, object_name, nb_ids):
+        nb_ids = set(nb_ids)
+        with self.cache_lock:
+            for cache_key in [x for x, y in self.nb_id_cache[object_name].items() if y in nb_ids]:
+                del self.nb_id_cache[object_name][cache_key]
+            if object_name == "devices":
+                for device_name in [x for x, y in self.device_index.items() if y.id in nb_ids]:
+                    del self.device_index[device_name]
+            if self.id_cache:
+                for nb_id in nb_ids:
+                    self.id_cache.delete(object_name, nb_id)
+            if self.fingerprints:
+                fingerprint_cache = self.fingerprint_cache.get(object_name, {})
+                for cache_key in [x for x, y in fingerprint_cache.items() if y[1] in nb_ids]:
+                    del fingerprint_cache[cache_key]
+                self.fingerprints.delete(object_name, nb_ids)
+
+    def mark_touched(self, object_name, nb_ids):
+        with self.cache_lock:
+            self.touched_ids[object_name].update(x for x in nb_ids if x)
+
+    def fingerprint(self, lookup_clause, normal_data, ip_list):
+        payload = json.dumps([self.nb_cache_key(lookup_clause), normal_data, sorted(ip_list)], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def unchanged_nb_id(self, object_name, lookup_clause, fingerprint):
+        if not self.fingerprints or self.verify_fingerprints:
+            return None
+        with self.cache_lock:
+            if object_name not in self.fingerprint_cache:
+                self.fingerprint_cache[object_name] = self.fingerprints.load(object_name)
+            stored = self.fingerprint_cache[object_name].get(self.nb_cache_key(lookup_clause))
+        nb_id = stored[1] if stored and stored[0] == fingerprint and stored[1] > 0 else None
+        self.metrics.count_fingerprint(object_name, bool(nb_id))
+        return nb_id
+
+    def skip_unchanged(self, object_name, lookup_clause, normal_data, nb_id):
+        logger.debug("UNCHANGED: %s, %s", object_name, lookup_clause, extra={"action": "skip", "object_type": object_name})
+        cache_key = self.nb_cache_key(lookup_clause)
+        # Re-caching a known ID would wipe the last_updated that incremental validation relies on
+        if self.nb_id_cache[object_name].get(cache_key) != nb_id:
+            self.cache_nb_id(object_name, cache_key, nb_id)
+        self.mark_touched(object_name, [nb_id])
+        if object_name == "devices":
+            self.index_device({**normal_data, "id": nb_id})
+
+    def store_fingerprints(self, object_name, rows):
+        if not self.fingerprints or not rows:
+            return
+        with self.cache_lock:
+            self.fingerprint_cache.setdefault(object_name, {}).update({x: (y, z) for x, y, z in rows})
+        self.fingerprints.set_many(object_name, rows)
+
+    def start_journal(self, resume=False):
+        if not self.journal:
+            return
+        self.journal.start(resume)
+        for object_name, entries in self.journal.entries.items():
+            for cache_key, nb_id in entries.values():
+                if self.nb_id_cache[object_name].get(cache_key) != nb_id:
+                    self.cache_nb_id(object_name, cache_key, nb_id)
+            # Records skipped on resume were still synced, prune must not take their objects for stale
+            self.mark_touched(object_name, [x for _, x in entries.values()])
+
+    def journal_results(self, object_name, rows):
+        if self.journal:
+            self.journal.record(object_name, [x for x in rows if x[2]])
+
+    def record_failure(self, object_name, objects_data, error):
+        with self.cache_lock:
+            self.failed_counts[object_name] += len(objects_data)
+        if self.journal:
+            self.journal.quarantine(object_name, objects_data, error)
+
+    def check_prunable(self, object_names):
+        failed = {x: self.failed_counts[x] for x in object_names if self.failed_counts[x]}
+        if failed:
+            raise Exception(f"Refusing to prune types with records that failed to sync in this run: {failed}")
+
+    def prune(self, object_name, lookup_clause=None, max_delete_ratio=0.1, max_delete=None):
+        self.check_prunable([object_name])
+        lookup_clause = lookup_clause or dict()
+        existing_ids = {x["id"] for x in self.filter_raw(object_name, {**lookup_clause, "brief": 1})}
+        stale_ids = sorted(existing_ids - self.touched_ids[object_name])
+        delete_limit = max_delete if max_delete is not None else int(len(existing_ids) * max_delete_ratio)
+        if len(stale_ids) > delete_limit:
+            raise Exception(
+                f"Refusing to delete {len(stale_ids)} of {len(existing_ids)} {object_name} matching {lookup_clause}, "
+                f"the limit is {delete_limit}"
+            )
+        for chunk in self.nb_chunks(stale_ids, self.bulk_chunk_size):
+            self.delete_object(object_name, chunk)
+            self.invalidate_nb_ids(object_name, chunk)
+            logger.info("BULK DELETE: %s, %s objects", object_name, len(chunk), extra={"action": "delete", "object_type": object_name})
+        return stale_ids
+
+    def prune_objects(self, prune_scopes, max_delete_ratio=0.1):
+        self.check_prunable(prune_scopes)
+        pruned = dict()
+        # Dependents go first, so nothing is left pointing at a deleted object
+        for object_name in reversed(self.sync_order(prune_scopes.keys())):
+            if object_name in prune_scopes:
+                pruned[object_name] = self.prune(object_name, prune_scopes[object_name], max_delete_ratio)
+        return pruned
+
+    @staticmethod
+    def nb_content_type(object_path):
+        app_label, endpoint = object_path.split(".")
+        model = re.sub(r"(?:(?<=ss)|(?<=x))es$|s$", "", endpoint.replace("_", "").replace("-", ""))
+        return f"{app_label}.{model}"
+
+    def validate_cache(self, object_names, cursor_overlap=300):
+        drift = {x: {"changed": [], "deleted": []} for x in object_names}
+        if not self.id_cache:
+            return drift
+        # The overlap absorbs clock skew with NetBox and writes still in flight, re-reading them is harmless
+        next_cursor = (datetime.now(timezone.utc) - timedelta(seconds=cursor_overlap)).isoformat()
+        cursors = dict()
+
+        for object_name in object_names:
+            object_conf = self.nb_objects[object_name]
+            cached_updates = self.id_cache.last_updated(object_name)
+            since = self.id_cache.get_cursor(object_name)
+            if not since and cached_updates and any(cached_updates.values()):
+                # No high-water mark yet, only records changed after the oldest cached state can have moved
+                since = min(x for x in cached_updates.values() if x)
+            cursors[object_name] = since
+
+            # A partial listing cannot tell whether a cache_lookups key (a rack name) is unique, only lookup_fields are
+            key_fields = [object_conf["lookup_fields"]]
+            record_fields = self.record_fields(object_name, key_fields)
+            if since:
+                nb_records = self.filter_raw(object_name, {"last_updated__gte": since}, record_fields)
+            else:
+                # Nothing cached means nothing to check, otherwise the cached IDs go in chunks to keep URLs short
+                nb_records = itertools.chain.from_iterable(
+                    self.filter_raw(object_name, {"id": x}, record_fields)
+                    for x in self.nb_chunks(sorted(cached_updates), self.lookup_chunk_size)
+                )
+            # Anything new, or changed since we last wrote or cached it, was changed outside of our syncs
+            changed = [x for x in nb_records if cached_updates.get(x["id"], UNRESOLVED) != x.get("last_updated")]
+            self.invalidate_nb_ids(object_name, [x["id"] for x in changed])
+            self.cache_records(object_name, changed, key_fields)
+            drift[object_name]["changed"] = [x["id"] for x in changed]
+
+        since = min((x for x in cursors.values() if x), default=None)
+        if since:
+            content_types = {self.nb_content_type(self.nb_objects[x]["path"]): x for x in object_names}
+            deleted = defaultdict(list)
+            for nb_change in self.filter_object_changes({"action": "delete", "time_after": since}):
+                object_name = content_types.get(nb_change.changed_object_type)
+                if object_name and cursors[object_name] and nb_change.time >= cursors[object_name]:
+                    deleted[object_name].append(nb_change.changed_object_id)
+            for object_name, nb_ids in deleted.items():
+                self.invalidate_nb_ids(object_name, nb_ids)
+                drift[object_name]["deleted"] = nb_ids
+
+        for object_name in object_names:
+            self.id_cache.set_cursor(object_name, next_cursor)
+            if drift[object_name]["changed"] or drift[object_name]["deleted"]:
+                logger.warning(
+                    "DRIFT: %s, %s changed, %s deleted outside of sync", object_name,
+                    len(drift[object_name]["changed"]), len(drift[object_name]["deleted"]),
+                    extra={"action": "drift", "object_type": object_name},
+                )
+        return drift
+
+    def cache_records(self, object_name, nb_records, key_fields):
+        seen_keys, last_updated = dict(), dict()
+        for nb_record in nb_records:
+            nb_id = self.nb_record_value(nb_record, "id")
+            last_updated[nb_id] = self.nb_record_value(nb_record, "last_updated")
+            for fields in key_fields:
+                lookup_clause = {x: self.nb_record_value(nb_record, x) for x in fields}
+                if None in lookup_clause.values():
+                    continue
+                cache_key = self.nb_cache_key(lookup_clause)
+                if seen_keys.setdefault(cache_key, nb_id) != nb_id:
+                    seen_keys[cache_key] = None
+            if object_name == "devices":
+                self.index_device(nb_record)
+        for cache_key, nb_id in seen_keys.items():
+            # Ambiguous keys (e.g. a rack name used in two sites) are left to the API lookup. A row without
+            # last_updated must not blank the one already stored for a known ID, validate_cache would see drift
+            if nb_id and (last_updated[nb_id] or self.nb_id_cache[object_name].get(cache_key) != nb_id):
+                self.cache_nb_id(object_name, cache_key, nb_id, last_updated[nb_id])
+        return set(seen_keys)
+
+    @staticmethod
+    def record_fields(object_name, key_fields):
+        # Just what cache_records reads, NetBox releases without field selection ignore it and send everything
+        fields = {"id", "last_updated"}
+        if object_name == "devices":
+            fields |= {"name", "site", "location", "rack"}
+        for field in itertools.chain(*key_fields):
+            fields.add(field[:-3] if field.endswith("_id") and field != "object_id" else field)
+        return fields
+
+    def index_device(self, nb_device):
+        with self.cache_lock:
+            self.device_index[self.nb_record_value(nb_device, "name")] = DeviceIndexEntry(
+                id=self.nb_record_value(nb_device, "id"),
+                site_id=self.nb_record_value(nb_device, "site_id"),
+                location_id=self.nb_record_value(nb_device, "location_id"),
+                rack_id=self.nb_record_value(nb_device, "rack_id"),
+            )
+
+    def build_device_index(self, lookup_clause=None):
+        nb_devices = self.filter_raw("devices", lookup_clause or {}, self.record_fields("devices", [["name"]]))
+        self.cache_records("devices", nb_devices, [["name"]])
+
+    def get_device(self, device_name):
+        device_entry = self.device_index.get(device_name)
+        if not device_entry:
+            nb_id = self.get_nb_id("devices", {"name": device_name})
+            if nb_id is UNRESOLVED:
+                return None
+            device_entry = self.device_index.get(device_name)
+        if not device_entry:
+            # Served from a persistent cache that only knows the ID
+            nb_device = self.get_objects_by_id("devices", [nb_id]).get(nb_id)
+            if not nb_device:
+                # Deleted outside of sync and dropped from the cache, look it up by name again
+                return self.get_device(device_name)
+            self.index_device(nb_device)
+            device_entry = self.device_index[device_name]
+        return device_entry
+
+    def warm_cache(self, object_names):
+        for object_name in object_names:
+            object_conf = self.nb_objects[object_name]
+            key_fields = [object_conf["lookup_fields"]] + object_conf.get("cache_lookups", [])
+            nb_records = self.filter_raw(object_name, {}, self.record_fields(object_name, key_fields))
+            self.cache_records(object_name, nb_records, key_fields)
+
+    @staticmethod
+    def graphql_choice_value(value):
+        # GraphQL enums come back as names (A_1000BASE_T, TAGGED_ALL), REST and our payloads use values
+        if isinstance(value, str) and re.fullmatch(r"[A-Z0-9_]+", value):
+            return re.sub(r"^A_", "", value).lower().replace("_", "-")
+        return value
+
+    def fetch_device_trees(self, device_names):
+        for chunk in self.nb_chunks(sorted(device_names), self.graphql_batch_size):
+            query = DEVICE_TREE_QUERY.replace("$filter", self.graphql_device_filter)
+            for nb_device in self.graphql(query, {"names": chunk})["device_list"]:
+                self.load_device_tree(nb_device)
+            self.loaded_device_trees.update(chunk)
+
+    def load_device_tree(self, nb_device):
+        nb_interfaces, nb_vlans, nb_ips = [], dict(), []
+        for field in ("status", "face"):
+            nb_device[field] = self.graphql_choice_value(nb_device.get(field))
+        for nb_interface in nb_device.pop("interfaces") or []:
+            nb_interface["device"] = {"id": nb_device["id"]}
+            for field in ("mode", "type", "duplex"):
+                nb_interface[field] = self.graphql_choice_value(nb_interface.get(field))
+            for nb_vlan in [nb_interface.get("untagged_vlan")] + (nb_interface.get("tagged_vlans") or []):
+                if nb_vlan:
+                    nb_vlans[nb_vlan["id"]] = nb_vlan
+            for nb_ip in nb_interface.pop("ip_addresses") or []:
+                nb_ips.append({**nb_ip, "assigned_object_type": "dcim.interface", "assigned_object_id": nb_interface["id"]})
+            nb_interfaces.append(nb_interface)
+
+        self.cache_records("devices", [nb_device], [["name"]])
+        self.cache_records("interfaces", nb_interfaces, [self.nb_objects["interfaces"]["lookup_fields"]])
+        self.cache_records("vlans", nb_vlans.values(), [["site_id", "vid"]])
+        self.cache_records("ip_addresses", nb_ips, [["address"]])
+        with self.cache_lock:
+            self.tree_snapshot["devices"][nb_device["id"]] = nb_device
+            self.tree_snapshot["interfaces"].update({x["id"]: x for x in nb_interfaces})
+            self.tree_snapshot["ip_addresses"].update({self.nb_ip_key(x["address"]): x for x in nb_ips})
+
+    def load_tags(self):
+        with self.tags_lock:
+            if not self.tags_loaded:
+                self.warm_cache(["tags"])
+                self.tags_loaded = True
+
+    def ensure_tags(self, tag_names):
+        self.load_tags()
+        with self.tags_lock:
+            missing_tags = sorted({x for x in tag_names if not self.nb_id_cache["tags"].get(f"name={x}")})
+            if missing_tags:
+                nb_tags = self.create_object("tags", [{"name": x, "slug": self.nb_slug(x)} for x in missing_tags])
+                logger.info("BULK CREATE: tags, %s", missing_tags, extra={"action": "create", "object_type": "tags"})
+                for nb_tag in nb_tags:
+                    self.cache_nb_id("tags", f"name={nb_tag.name}", nb_tag.id, getattr(nb_tag, "last_updated", None))
+
+    def resolve_references(self, references):
+        found_keys = set()
+        ref_groups = dict()
+        for object_name, lookup_items in references:
+            ref_groups.setdefault((object_name, tuple(x for x, _ in lookup_items)), []).append(dict(lookup_items))
+
+        for (object_name, fields), lookup_clauses in ref_groups.items():
+            # The field with most distinct values goes into the multi-value filter, the rest stay fixed
+            vary_field = max(fields, key=lambda x: len({str(y[x]) for y in lookup_clauses}))
+            fixed_groups = dict()
+            for lookup_clause in lookup_clauses:
+                fixed_items = tuple((x, y) for x, y in lookup_clause.items() if x != vary_field)
+                fixed_groups.setdefault(fixed_items, set()).add(lookup_clause[vary_field])
+            for fixed_items, vary_values in fixed_groups.items():
+                for chunk in self.nb_chunks(sorted(vary_values, key=str), self.lookup_chunk_size):
+                    lookup_clause = {**dict(fixed_items), vary_field: chunk}
+                    nb_records = self.filter_raw(object_name, lookup_clause, self.record_fields(object_name, [fields]))
+                    found_keys |= self.cache_records(object_name, nb_records, [list(fields)])
+        return found_keys
+
+    def prefetch_references(self, object_name, objects_data, max_rounds=5):
+        resolved = set()
+        if self.auto_create_tags:
+            self.ensure_tags({x for y in objects_data for x in y.get("tags") or []})
+        if self.use_graphql and object_name == "interfaces":
+            self.fetch_device_trees({x["device"] for x in objects_data if x.get("device")} - self.loaded_device_trees)
+        if not callable(self.nb_objects[object_name].get("normalization_fn")):
+            # Table-only types reference plain names, their lookups are known without a dry run
+            references = self.resolver_references(object_name, objects_data)
+            if references:
+                self.resolve_references(references)
+            return
+        for _ in range(max_rounds):
+            # Dry-run normalization on copies, get_nb_id records cache misses instead of fetching them
+            self.thread_state.pending_refs = set()
+            try:
+                for object_data in objects_data:
+                    try:
+                        self.normalization(object_name, copy.deepcopy(object_data))
+                    except Exception:
+                        pass
+                references = self.thread_state.pending_refs - resolved
+            finally:
+                self.thread_state.pending_refs = None
+            if not references:
+                break
+            self.resolve_references(references)
+            resolved |= references
+
+    def prefetch_wave(self, object_name, objects_data):
+        try:
+            self.prefetch_references(object_name, objects_data)
+        except Exception as e:
+            # Every record still resolves its own references, so only the records at fault fail
+            logger.warning(
+                "PREFETCH FAILED: %s, %s", object_name, e, extra={"action": "prefetch", "object_type": object_name}
+            )
+
+    def self_ref_waves(self, object_name, objects_data):
+        object_conf = self.nb_objects[object_name]
+        self_refs = object_conf.get("self_refs", [])
+        required_fields = object_conf["required_fields"]
+        indexed_data = list(enumerate(objects_data))
+        if not self_refs:
+            return [indexed_data]
+
+        # Records referencing another record of the same batch (parent, lag) go in a later wave
+        record_index = {tuple(str(x.get(y)) for y in required_fields): i for i, x in indexed_data}
+        depths = dict()
+
+        def record_depth(i, seen):
+            if i not in depths:
+                parent_depths = [-1]
+                for self_ref in self_refs:
+                    ref_value = objects_data[i].get(self_ref)
+                    if not ref_value:
+                        continue
+                    ref_key = tuple(
+                        str(ref_value) if x == "name" else str(objects_data[i].get(x)) for x in required_fields
+                    )
+                    parent = record_index.get(ref_key)
+                    if parent is not None and parent not in seen:
+                        parent_depths.append(record_depth(parent, seen | {i}))
+                depths[i] = max(parent_depths) + 1
+            return depths[i]
+
+        waves = dict()
+        for i, object_data in indexed_data:
+            waves.setdefault(record_depth(i, {i}), []).append((i, object_data))
+        return [waves[x] for x in sorted(waves)]
+
+    def bulk_create_update(self, object_name, objects_data, skip_if_exist=False):
+        nb_results = [None] * len(objects_data)
+        interface_ips = []
+        fingerprints, cache_keys = dict(), dict()
+        journal_keys = [self.journal.input_key(x) for x in objects_data] if self.journal else None
+
+        for wave in self.self_ref_waves(object_name, objects_data):
+            create_list, existing_list, update_list, update_keys = [], [], [], dict()
+            self.prefetch_references(object_name, [x for _, x in wave])
+            merged, duplicates = dict(), defaultdict(list)
+            for i, object_data in wave:
+                normal_data = self.normalization(object_name, object_data)
+                ip_list = self.pop_interface_ips(object_name, normal_data)
+                lookup_clause = self.lookup(object_name, normal_data)
+                cache_keys[i] = self.nb_cache_key(lookup_clause)
+                if cache_keys[i] in merged:
+                    # The same object listed twice ends up as sequential writes would leave it: later fields win
+                    first_i, _, first_data, first_ips, _ = merged.pop(cache_keys[i])
+                    duplicates[i] += duplicates.pop(first_i, []) + [first_i]
+                    normal_data, ip_list = {**first_data, **normal_data}, first_ips + ip_list
+                merged[cache_keys[i]] = (i, object_data, normal_data, ip_list, lookup_clause)
+
+            normalized_wave = []
+            for i, object_data, normal_data, ip_list, lookup_clause in merged.values():
+                fingerprints[i] = (cache_keys[i], self.fingerprint(lookup_clause, normal_data, ip_list))
+                nb_id = self.unchanged_nb_id(object_name, lookup_clause, fingerprints[i][1])
+                if nb_id:
+                    self.skip_unchanged(object_name, lookup_clause, normal_data, nb_id)
+                    nb_results[i] = nb_id
+                    del fingerprints[i]
+                    continue
+                normalized_wave.append((i, object_data, normal_data, ip_list, lookup_clause))
+            # The objects themselves are looked up the same batched way as their references
+            found_keys = self.resolve_references({
+                (object_name, tuple(sorted(x[4].items()))) for x in normalized_wave
+                if not self.nb_id_cache[object_name].get(self.nb_cache_key(x[4]))
+            })
+
+            for i, object_data, normal_data, ip_list, lookup_clause in normalized_wave:
+                cache_key = self.nb_cache_key(lookup_clause)
+                nb_object = self.nb_id_cache[object_name].get(cache_key)
+                if not nb_object and cache_key in found_keys:
+                    nb_object = self.get_object(object_name, lookup_clause)
+                if not nb_object:
+                    create_list.append((i, cache_key, normal_data, ip_list))
+                elif skip_if_exist:
+                    logger.info("SKIPPING UPDATE: %s, %s", object_name, object_data, extra={"action": "skip", "object_type": object_name})
+                    nb_id = getattr(nb_object, "id", nb_object)
+                    self.cache_nb_id(object_name, cache_key, nb_id)
+                    nb_results[i] = nb_id
+                    interface_ips += [(nb_id, x) for x in ip_list]
+                else:
+                    existing_list.append((i, cache_key, normal_data, ip_list, nb_object))
+
+            # Cached IDs carry no field values, fetch their records in chunks to diff against
+            nb_records = self.get_objects_by_id(
+                object_name, [x[4] for x in existing_list if isinstance(x[4], int)],
+                set().union(*[x[2].keys() for x in existing_list]),
+            )
+            for i, cache_key, normal_data, ip_list, nb_object in existing_list:
+                if isinstance(nb_object, int):
+                    nb_object = nb_records.get(nb_object)
+                if not nb_object:
+                    create_list.append((i, cache_key, normal_data, ip_list))
+                    continue
+                nb_id = self.nb_record_value(nb_object, "id")
+                self.cache_nb_id(object_name, cache_key, nb_id, self.nb_record_value(nb_object, "last_updated"))
+                nb_results[i] = nb_id
+                interface_ips += [(nb_id, x) for x in ip_list]
+                object_diff = self.nb_diff(nb_object, normal_data)
+                if object_diff:
+                    update_list.append({**object_diff, "id": nb_id})
+                    update_keys[nb_id] = cache_key
+
+            for chunk in self.nb_chunks(create_list, self.bulk_chunk_size):
+                nb_created = self.create_object(object_name, [x[2] for x in chunk])
+                logger.info("BULK CREATE: %s, %s objects", object_name, len(nb_created), extra={"action": "create", "object_type": object_name})
+                for (i, cache_key, _, ip_list), nb_object in zip(chunk, nb_created):
+                    self.cache_nb_id(object_name, cache_key, nb_object.id, getattr(nb_object, "last_updated", None))
+                    nb_results[i] = nb_object.id
+                    interface_ips += [(nb_object.id, x) for x in ip_list]
+
+            for chunk in self.nb_chunks(update_list, self.bulk_chunk_size):
+                for nb_object in self.update_objects(object_name, chunk):
+                    # Keep our own writes from looking like drift to the next incremental run
+                    self.cache_nb_id(
+                        object_name, update_keys[nb_object.id], nb_object.id, getattr(nb_object, "last_updated", None)
+                    )
+                logger.info("BULK UPDATE: %s, %s objects", object_name, len(chunk), extra={"action": "update", "object_type": object_name})
+
+            for i, duplicate_indexes in duplicates.items():
+                for duplicate_i in duplicate_indexes:
+                    nb_results[duplicate_i] = nb_results[i]
+
+            if object_name == "devices":
+                for i, _, normal_data, _, _ in normalized_wave:
+                    if nb_results[i]:
+                        self.index_device({**normal_data, "id": nb_results[i]})
+
+        self.mark_touched(object_name, nb_results)
+        if interface_ips:
+            self.sync_interface_ips(interface_ips)
+        self.store_fingerprints(object_name, [(x, y, nb_results[i]) for i, (x, y) in fingerprints.items() if nb_results[i]])
+        if self.journal:
+            self.journal_results(object_name, [(journal_keys[i], x, nb_results[i]) for i, x in cache_keys.items()])
+
+        return nb_results
+
+    def sync_dependencies(self, object_names):
+        object_names = set(object_names)
+        dependencies = dict()
+        for object_name in object_names:
+            # Every type can carry tags, so tags always go first
+            depends_on = set(self.nb_objects[object_name].get("depends_on", [])) | {"tags"}
+            dependencies[object_name] = (depends_on & object_names) - {object_name}
+        return dependencies
+
+    def sync_order(self, object_names):
+        dependencies = self.sync_dependencies(object_names)
+        ordered = []
+        while len(ordered) < len(dependencies):
+            ready = sorted(x for x, y in dependencies.items() if x not in ordered and y <= set(ordered))
+            if not ready:
+                raise Exception(f"Circular dependency between: {set(dependencies) - set(ordered)}")
+            ordered += ready
+        return ordered
+
+    def sync_type(self, record_pool, object_name, objects_data, errors):
+        for wave in self.self_ref_waves(object_name, objects_data):
+            self.prefetch_wave(object_name, [x for _, x in wave])
+            futures = dict()
+            for _, object_data in wave:
+                # Copied before submitting, normalization rewrites the record in place
+                source_data = dict(object_data)
+                futures[record_pool.submit(self.create_update_object, object_name, object_data)] = source_data
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append((futures[future], e))
+                    self.record_failure(object_name, [futures[future]], e)
+                    logger.error("FAILED: %s, %s, %s", object_name, futures[future], e, extra={"action": "fail", "object_type": object_name})
+
+    def sync(self, objects_data, type_workers=4, record_workers=8, resume=False):
+        self.start_journal(resume)
+        if resume and self.journal:
+            objects_data = {x: [z for z in y if not self.journal.journaled(x, z)] for x, y in objects_data.items()}
+        dependencies = self.sync_dependencies(objects_data.keys())
+        errors = {x: [] for x in objects_data}
+        running, done = dict(), set()
+
+        with ThreadPoolExecutor(type_workers) as type_pool, ThreadPoolExecutor(record_workers) as record_pool:
+            while len(done) < len(dependencies):
+                for object_name, depends_on in dependencies.items():
+                    if object_name in done or object_name in running.values() or not depends_on <= done:
+                        continue
+                    future = type_pool.submit(
+                        self.sync_type, record_pool, object_name, objects_data[object_name], errors[object_name]
+                    )
+                    running[future] = object_name
+                if not running:
+                    raise Exception(f"Circular dependency between: {set(dependencies) - done}")
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done.add(running.pop(future))
+                    future.result()
+
+        return errors
+
+    @staticmethod
+    def read_ndjson(source):
+        if isinstance(source, str):
+            with open(source) as ndjson_file:
+                yield from ndjson_file
+        else:
+            yield from source
+
+    @staticmethod
+    def parse_records(lines):
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                yield record["object_type"], record["data"]
+            except (ValueError, KeyError) as e:
+                raise Exception(f"Invalid record on line {line_number}: {e}")
+
+    def validate_records(self, records, errors):
+        for object_name, object_data in records:
+            try:
+                self.validate(object_name, object_data)
+            except Exception as e:
+                errors.setdefault(object_name, []).append((object_data, e))
+                self.record_failure(object_name, [object_data], e)
+                logger.error("FAILED: %s, %s, %s", object_name, object_data, e, extra={"action": "fail", "object_type": object_name})
+                continue
+            yield object_name, object_data
+
+    @staticmethod
+    def batch_records(records, batch_size):
+        batch_name, batch = None, []
+        for object_name, object_data in records:
+            if batch and (object_name != batch_name or len(batch) >= batch_size):
+                yield batch_name, batch
+                batch = []
+            batch_name = object_name
+            batch.append(object_data)
+        if batch:
+            yield batch_name, batch
+
+    def sync_ndjson(self, source, batch_size=500, max_in_flight=2, resume=False):
+        return self.sync_records(self.parse_records(self.read_ndjson(source)), batch_size, max_in_flight, resume)
+
+    def sync_records(self, records, batch_size=500, max_in_flight=2, resume=False):
+        self.start_journal(resume)
+        errors = dict()
+        in_flight = deque()
+
+        def write_batch(object_name, batch):
+            batch_data = [dict(x) for x in batch]
+            try:
+                self.bulk_create_update(object_name, batch)
+            except Exception as e:
+                errors.setdefault(object_name, []).extend((x, e) for x in batch_data)
+                self.record_failure(object_name, batch_data, e)
+                logger.error("FAILED: %s, batch of %s, %s", object_name, len(batch), e, extra={"action": "fail", "object_type": object_name})
+
+        def drain(max_pending):
+            while len(in_flight) > max_pending:
+                in_flight.popleft()[1].result()
+
+        records = self.validate_records(records, errors)
+        if resume and self.journal:
+            records = ((x, y) for x, y in records if not self.journal.journaled(x, y))
+        with ThreadPoolExecutor(max_in_flight) as write_pool:
+            for object_name, batch in self.batch_records(records, batch_size):
+                # Later types depend on earlier ones, and self-referencing records may span batches
+                if in_flight and (in_flight[-1][0] != object_name or self.nb_objects[object_name].get("self_refs")):
+                    drain(0)
+                # Backpressure: no new batch is parsed until a write slot frees up
+                drain(max_in_flight - 1)
+                in_flight.append((object_name, write_pool.submit(write_batch, object_name, batch)))
+            drain(0)
+
+        return errors
+
+    def shard_key(self, object_name, object_data, device_sites):
+        shard_by = self.nb_objects[object_name]["shard_by"]
+        if shard_by == "site":
+            return str(object_data.get("site"))
+        # Devices unknown to NetBox too keep their records together, self references stay within one shard
+        device_name = str(object_data.get("device"))
+        return device_sites.get(device_name, f"device={device_name}")
+
+    def shard_records(self, objects_data, processes):
+        device_sites = {str(x.get("name")): str(x.get("site")) for x in objects_data.get("devices", [])}
+        # Devices outside this input take their site from NetBox, so auto-creates in one site stay in one worker
+        missing_devices = sorted({
+            str(y.get("device")) for x, records in objects_data.items()
+            if self.nb_objects[x]["shard_by"] == "device" for y in records
+        } - set(device_sites))
+        for chunk in self.nb_chunks(missing_devices, self.lookup_chunk_size):
+            for nb_device in self.filter_raw("devices", {"name": chunk}, {"id", "name", "site"}):
+                device_sites[nb_device["name"]] = nb_device["site"]["name"]
+        shard_groups = defaultdict(lambda: defaultdict(list))
+        for object_name, records in objects_data.items():
+            for object_data in records:
+                shard_groups[self.shard_key(object_name, object_data, device_sites)][object_name].append(object_data)
+        # Largest sites first onto the least loaded worker keeps the workers finishing together
+        shards = [defaultdict(list) for _ in range(min(processes, len(shard_groups)))]
+        shard_sizes = [0] * len(shards)
+        for group in sorted(shard_groups.values(), key=lambda x: -sum(len(y) for y in x.values())):
+            i = shard_sizes.index(min(shard_sizes))
+            for object_name, records in group.items():
+                shards[i][object_name] += records
+            shard_sizes[i] += sum(len(x) for x in group.values())
+        return [dict(x) for x in shards]
+
+    @staticmethod
+    def sync_shard(url, token, shard_kwargs, store_args, nb_id_cache, shard_data, batch_size):
+        id_cache_args, fingerprint_args = store_args
+        nb = NetBox(
+            url, token,
+            id_cache=SqliteIdCache(*id_cache_args) if id_cache_args else None,
+            fingerprints=SqliteFingerprintStore(*fingerprint_args) if fingerprint_args else None,
+            **shard_kwargs,
+        )
+        for object_name, cached in nb_id_cache.items():
+            nb.nb_id_cache[object_name].update(cached)
+        errors = nb.sync_records([(x, y) for x in nb.sync_order(shard_data) for y in shard_data[x]], batch_size)
+        # Exceptions carrying HTTP responses do not survive pickling, their message does
+        errors = {x: [(y, Exception(str(z))) for y, z in e] for x, e in errors.items()}
+        return errors, nb.metrics, nb.touched_ids, {x: nb.nb_id_cache[x] for x in shard_data}
+
+    def sync_sharded(self, objects_data, processes=None, batch_size=500):
+        if self.journal:
+            raise Exception("Sharded syncs do not support a journal")
+        processes = processes or os.cpu_count()
+        # Types that depend on site-scoped ones run after the shards, everything else before them
+        dependencies = self.sync_dependencies(objects_data.keys())
+        sharded, before, after = [], [], []
+        for object_name in self.sync_order(objects_data.keys()):
+            if self.nb_objects[object_name].get("shard_by"):
+                sharded.append(object_name)
+            elif dependencies[object_name] & set(sharded + after):
+                after.append(object_name)
+            else:
+                before.append(object_name)
+
+        errors = self.sync_records([(x, y) for x in before for y in objects_data[x]], batch_size)
+        shards = self.shard_records({x: objects_data[x] for x in sharded}, processes)
+        nb_id_cache = {x: y for x, y in self.nb_id_cache.items() if y and x not in sharded}
+        store_args = (
+            (self.id_cache.path, self.id_cache.ttl, self.id_cache.type_ttls) if self.id_cache else None,
+            (self.fingerprints.path, self.fingerprints.verify_after) if self.fingerprints else None,
+        )
+        logger.info("SHARDED SYNC: %s shards of %s", len(shards), sharded, extra={"action": "shard"})
+        # Spawned workers start clean instead of inheriting this process' threads and sockets
+        with ProcessPoolExecutor(len(shards) or 1, mp_context=multiprocessing.get_context("spawn")) as shard_pool:
+            futures = [
+                shard_pool.submit(
+                    NetBox.sync_shard, self.url, self.token, self.shard_kwargs, store_args, nb_id_cache, x, batch_size
+                )
+                for x in shards
+            ]
+            for future in futures:
+                shard_errors, shard_metrics, touched_ids, shard_cache = future.result()
+                for object_name, object_errors in shard_errors.items():
+                    errors.setdefault(object_name, []).extend(object_errors)
+                    self.failed_counts[object_name] += len(object_errors)
+                self.metrics.merge(shard_metrics)
+                with self.cache_lock:
+                    for object_name, nb_ids in touched_ids.items():
+                        self.touched_ids[object_name] |= nb_ids
+                    for object_name, cached in shard_cache.items():
+                        self.nb_id_cache[object_name].update(cached)
+
+        for object_name, object_errors in self.sync_records([(x, y) for x in after for y in objects_data[x]], batch_size).items():
+            errors.setdefault(object_name, []).extend(object_errors)
+        return errors
+
     def get_nb_id(self, object_name, lookup_clause):
-        cache_key = "__".join([f"{x}={y}" for x, y in lookup_clause.items()])
+        cache_key = self.nb_cache_key(lookup_clause)
         cache_value = self.nb_id_cache[object_name].get(cache_key)
+        pending_refs = getattr(self.thread_state, "pending_refs", None)
+        if pending_refs is None:
+            self.metrics.count_cache(object_name, bool(cache_value))
         if cache_value:
             return cache_value
+        elif pending_refs is not None:
+            if UNRESOLVED not in lookup_clause.values():
+                pending_refs.add((object_name, tuple(sorted(lookup_clause.items()))))
+            return UNRESOLVED
         else:
             get_nb_object = self.get_object(object_name, lookup_clause)
             create_absent_fn = self.nb_objects[object_name].get("create_if_absent")
             if not get_nb_object and callable(create_absent_fn):
-                nb_id = create_absent_fn(lookup_clause).id
-                self.nb_id_cache[object_name][cache_key] = nb_id
+                with self.cache_lock:
+                    create_lock = self.create_locks[(object_name, cache_key)]
+                with create_lock:
+                    # Another worker may have created it while we were looking it up
+                    nb_id = self.nb_id_cache[object_name].get(cache_key)
+                    if not nb_id:
+                        nb_object = create_absent_fn(lookup_clause)
+                        nb_id = nb_object.id
+                        self.cache_nb_id(object_name, cache_key, nb_id, getattr(nb_object, "last_updated", None))
+                        self.mark_touched(object_name, [nb_id])
                 return nb_id
             elif not get_nb_object:
                 raise Exception(f"Unable to find {object_name}, with data: {lookup_clause}")
             else:
                 nb_id = get_nb_object.id
-                self.nb_id_cache[object_name][cache_key] = nb_id
+                self.cache_nb_id(object_name, cache_key, nb_id, getattr(get_nb_object, "last_updated", None))
+                if object_name == "devices":
+                    self.index_device(get_nb_object)
                 return nb_id
 
     def get_object(self, object_name, lookup_clause):
         object_path = self.nb_objects[object_name]["path"]
-        return operator.attrgetter(object_path)(self.nb).get(**lookup_clause)
+        with self.metrics.timed_call(object_name, "get"):
+            return operator.attrgetter(object_path)(self.nb).get(**lookup_clause)
 
-    def get_all(self, object_name):
+    def nb_record(self, object_name, values):
         object_path = self.nb_objects[object_name]["path"]
-        return operator.attrgetter(object_path)(self.nb).all()
+        return Record(values, self.nb, operator.attrgetter(object_path)(self.nb))
+
+    def object_url(self, object_name, nb_id=None):
+        object_path = self.nb_objects[object_name]["path"].replace(".", "/").replace("_", "-")
+        return f"/{object_path}/{nb_id}/" if nb_id else f"/{object_path}/"
+
+    def get_all(self, object_name, page_size=None):
+        return self.filter_object(object_name, {}, page_size)
 
     def create_object(self, object_name, object_data):
         object_path = self.nb_objects[object_name]["path"]
-        return operator.attrgetter(object_path)(self.nb).create(object_data)
+        with self.metrics.timed_call(object_name, "create"):
+            return operator.attrgetter(object_path)(self.nb).create(object_data)
+
+    def get_objects_by_id(self, object_name, nb_ids, fields=None):
+        nb_records = dict()
+        snapshot = self.tree_snapshot.get(object_name)
+        if snapshot:
+            with self.cache_lock:
+                snapshot_records = {x: snapshot.pop(x) for x in nb_ids if x in snapshot}
+            # A snapshot record lacking a field we are about to diff would hide changes to it
+            nb_records.update({x: y for x, y in snapshot_records.items() if not fields or fields <= set(y)})
+        record_fields = fields | {"id", "last_updated"} if fields else None
+        for chunk in self.nb_chunks(list(set(nb_ids) - set(nb_records)), self.lookup_chunk_size):
+            nb_records.update({x["id"]: x for x in self.filter_raw(object_name, {"id": chunk}, record_fields)})
+        # IDs NetBox no longer knows about must not be served from the cache again
+        for nb_id in set(nb_ids) - set(nb_records):
+            self.invalidate_nb_id(object_name, nb_id)
+        return nb_records
+
+    def update_objects(self, object_name, objects_data):
+        object_path = self.nb_objects[object_name]["path"]
+        with self.metrics.timed_call(object_name, "update"):
+            return operator.attrgetter(object_path)(self.nb).update(objects_data)
 
     def create_absent_vlan(self, vlan_data):
-        print(f"CREATE {vlan_data}")
+        logger.info("CREATE: vlans, %s", vlan_data, extra={"action": "create", "object_type": "vlans"})
         create_data = {
             "name": f"VLAN{vlan_data['vid']}",
             "vid": vlan_data["vid"],
@@ -586,7 +2086,9 @@ class NetBox:
         return self.create_object("vlans", create_data)
 
     def create_absent_interface(self, interface_data):
-        print(f"CREATE {interface_data}")
+        logger.info(
+            "CREATE: interfaces, %s", interface_data, extra={"action": "create", "object_type": "interfaces"}
+        )
         create_data = {
             "name": interface_data["name"],
             "device": interface_data["device_id"],
@@ -594,9 +2096,397 @@ class NetBox:
         }
         return self.create_object("interfaces", create_data)
 
-    def delete_object(self, object_path, object_data):
-        pass
+    def graphql(self, query, variables=None):
+        with self.metrics.timed_call("graphql", "query"):
+            response = self.nb.http_session.post(
+                self.graphql_url,
+                json={"query": query, "variables": variables or {}},
+                headers={"Authorization": f"Token {self.nb.token}", "Accept": "application/json"},
+            )
+        response.raise_for_status()
+        result = response.json()
+        if result.get("errors"):
+            raise Exception(f"GraphQL query failed: {result['errors']}")
+        return result["data"]
+
+    def filter_object_changes(self, lookup_clause):
+        with self.metrics.timed_call("object_changes", "filter"):
+            return list(self.nb.extras.object_changes.filter(**lookup_clause))
 
-    def filter_object(self, object_name, lookup_clause):
+    def delete_object(self, object_name, nb_ids):
         object_path = self.nb_objects[object_name]["path"]
-        return operator.attrgetter(object_path)(self.nb).filter(**lookup_clause)
\ No newline at end of file
+        with self.metrics.timed_call(object_name, "delete"):
+            return operator.attrgetter(object_path)(self.nb).delete(nb_ids)
+
+    def filter_object(self, object_name, lookup_clause, page_size=None):
+        return (self.nb_record(object_name, x) for x in self.filter_raw(object_name, lookup_clause, page_size=page_size))
+
+    def get_page(self, object_name, params):
+        with self.metrics.timed_call(object_name, "filter"):
+            response = self.nb.http_session.get(
+                self.nb.base_url + self.object_url(object_name), params=params,
+                headers={"Authorization": f"Token {self.nb.token}", "Accept": "application/json"},
+            )
+        response.raise_for_status()
+        return response.json()
+
+    def filter_raw(self, object_name, lookup_clause, fields=None, page_size=None):
+        # Plain JSON rows for the cache and diff paths, building Records for them costs more than the request
+        params = {**lookup_clause, "limit": page_size or self.page_size}
+        if fields:
+            params["fields"] = ",".join(sorted(fields))
+        response = self.get_page(object_name, params)
+        yield from response["results"]
+        if not response["next"]:
+            return
+        # NetBox caps the limit at MAX_PAGE_SIZE, step by what the first page actually held
+        offsets = range(len(response["results"]), response["count"], len(response["results"]))
+        with ThreadPoolExecutor(self.page_workers) as page_pool:
+            pages = deque()
+            for offset in offsets:
+                pages.append(page_pool.submit(self.get_page, object_name, {**params, "offset": offset}))
+                # Only a window of pages is held in memory ahead of the consumer
+                if len(pages) >= self.page_workers:
+                    yield from pages.popleft().result()["results"]
+            while pages:
+                yield from pages.popleft().result()["results"]
+
+
+class AsyncNetBox(NetBox):
+    def __init__(self, url, token, concurrency=50, max_connections=100, keepalive_expiry=30, **kwargs):
+        super().__init__(url, token, **kwargs)
+        if httpx is None:
+            raise Exception("AsyncNetBox requires the httpx package")
+
+        self.concurrency = concurrency
+        self.client_limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.client = None
+        self.loop = None
+        self.loop_thread = None
+        self.semaphore = None
+        self.executor = None
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(
+            base_url=self.nb.base_url,
+            headers={
+                "Authorization": f"Token {self.token}",
+                "Accept": "application/json",
+            },
+            limits=self.client_limits,
+            timeout=60,
+            verify=False,
+        )
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        # Normalization functions resolve references synchronously, they run here and call back into the loop
+        self.executor = ThreadPoolExecutor(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.executor.shutdown()
+        await self.client.aclose()
+
+    def run_sync(self, coroutine):
+        if self.loop is None or threading.current_thread() is self.loop_thread:
+            raise Exception("Blocking AsyncNetBox calls must run outside the event loop thread")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def request(self, verb, url, params=None, data=None):
+        adapter = self.http_adapter
+        for attempt in itertools.count():
+            response, error = None, None
+            async with self.semaphore:
+                try:
+                    response = await self.client.request(verb, url, params=params, json=data)
+                except httpx.TransportError as e:
+                    error = e
+
+            status = error.__class__.__name__ if error else response.status_code
+            retryable = status == 429 or (
+                verb in adapter.idempotent_verbs and (error or status in adapter.retry_statuses)
+            )
+            if not retryable or attempt >= adapter.retries:
+                break
+
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            delay = adapter.retry_delay(retry_after, attempt, adapter.backoff, adapter.backoff_max)
+            self.metrics.count_retry(verb, status)
+            logger.warning(
+                "RETRY: %s %s, %s, attempt %s in %.2fs", verb, url, status, attempt + 1, delay,
+                extra={"action": "retry"},
+            )
+            await asyncio.sleep(delay)
+
+        if error:
+            raise error
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    async def get_object_async(self, object_name, lookup_clause):
+        with self.metrics.timed_call(object_name, "get"):
+            response = await self.request("GET", self.object_url(object_name), params={**lookup_clause, "limit": 2})
+        if response["count"] > 1:
+            raise ValueError(f"get() returned more than one result for {object_name}, with data: {lookup_clause}")
+        if response["results"]:
+            return self.nb_record(object_name, response["results"][0])
+
+    async def get_page_async(self, object_name, params):
+        with self.metrics.timed_call(object_name, "filter"):
+            return await self.request("GET", self.object_url(object_name), params=params)
+
+    async def filter_raw_async(self, object_name, lookup_clause, fields=None, page_size=None):
+        params = {**lookup_clause, "limit": page_size or self.page_size}
+        if fields:
+            params["fields"] = ",".join(sorted(fields))
+        response = await self.get_page_async(object_name, params)
+        nb_records = response["results"]
+        if response["next"]:
+            # The request semaphore bounds how many of these run at once
+            offsets = range(len(response["results"]), response["count"], len(response["results"]))
+            pages = await asyncio.gather(
+                *[self.get_page_async(object_name, {**params, "offset": x}) for x in offsets]
+            )
+            nb_records += [x for y in pages for x in y["results"]]
+        return nb_records
+
+    async def filter_object_async(self, object_name, lookup_clause, page_size=None):
+        nb_records = await self.filter_raw_async(object_name, lookup_clause, page_size=page_size)
+        return [self.nb_record(object_name, x) for x in nb_records]
+
+    async def get_all_async(self, object_name, page_size=None):
+        return await self.filter_object_async(object_name, {}, page_size)
+
+    async def create_object_async(self, object_name, object_data):
+        with self.metrics.timed_call(object_name, "create"):
+            response = await self.request("POST", self.object_url(object_name), data=object_data)
+        if isinstance(response, list):
+            return [self.nb_record(object_name, x) for x in response]
+        return self.nb_record(object_name, response)
+
+    async def update_objects_async(self, object_name, objects_data):
+        with self.metrics.timed_call(object_name, "update"):
+            response = await self.request("PATCH", self.object_url(object_name), data=objects_data)
+        return [self.nb_record(object_name, x) for x in response]
+
+    async def delete_object_async(self, object_name, nb_ids):
+        with self.metrics.timed_call(object_name, "delete"):
+            await self.request("DELETE", self.object_url(object_name), data=[{"id": x} for x in nb_ids])
+        return True
+
+    def get_object(self, object_name, lookup_clause):
+        return self.run_sync(self.get_object_async(object_name, lookup_clause))
+
+    def filter_object(self, object_name, lookup_clause, page_size=None):
+        return self.run_sync(self.filter_object_async(object_name, lookup_clause, page_size))
+
+    def filter_raw(self, object_name, lookup_clause, fields=None, page_size=None):
+        return self.run_sync(self.filter_raw_async(object_name, lookup_clause, fields, page_size))
+
+    def get_all(self, object_name, page_size=None):
+        return self.run_sync(self.get_all_async(object_name, page_size))
+
+    def create_object(self, object_name, object_data):
+        return self.run_sync(self.create_object_async(object_name, object_data))
+
+    def update_objects(self, object_name, objects_data):
+        return self.run_sync(self.update_objects_async(object_name, objects_data))
+
+    def delete_object(self, object_name, nb_ids):
+        return self.run_sync(self.delete_object_async(object_name, nb_ids))
+
+    async def prune_objects_async(self, prune_scopes, max_delete_ratio=0.1):
+        return await self.loop.run_in_executor(self.executor, self.prune_objects, prune_scopes, max_delete_ratio)
+
+    async def create_update_object_async(self, object_name, object_data, skip_if_exist=False):
+        # Normalization and the cache bookkeeping block on locks and SQLite, they stay off the event loop
+        pending = await self.loop.run_in_executor(self.executor, self.prepare_write, object_name, object_data)
+        normal_data = pending.normal_data
+        if pending.unchanged_id:
+            return self.nb_record(object_name, {**normal_data, "id": pending.unchanged_id})
+        nb_object = await self.get_object_async(object_name, pending.lookup_clause)
+
+        if nb_object and skip_if_exist:
+            logger.info("SKIPPING UPDATE: %s, %s", object_name, object_data, extra={"action": "skip", "object_type": object_name})
+        elif nb_object:
+            object_diff = self.nb_diff(nb_object, normal_data)
+            if object_diff:
+                with self.metrics.timed_call(object_name, "update"):
+                    nb_object = self.nb_record(object_name, await self.request(
+                        "PATCH", self.object_url(object_name, nb_object.id), data=object_diff
+                    ))
+                logger.info("UPDATE: %s, %s", object_name, object_diff, extra={"action": "update", "object_type": object_name})
+        else:
+            nb_object = await self.create_object_async(object_name, normal_data)
+            logger.info("CREATE: %s, %s", object_name, normal_data, extra={"action": "create", "object_type": object_name})
+
+        await self.loop.run_in_executor(self.executor, self.finish_write, object_name, pending, nb_object)
+        return nb_object
+
+    async def sync_type_async(self, object_name, objects_data, errors):
+        for wave in self.self_ref_waves(object_name, objects_data):
+            wave_data = [dict(x) for _, x in wave]
+            await self.loop.run_in_executor(self.executor, self.prefetch_wave, object_name, [x for _, x in wave])
+            results = await asyncio.gather(
+                *[self.create_update_object_async(object_name, x) for _, x in wave],
+                return_exceptions=True,
+            )
+            for object_data, result in zip(wave_data, results):
+                if isinstance(result, Exception):
+                    errors.append((object_data, result))
+                    self.record_failure(object_name, [object_data], result)
+                    logger.error("FAILED: %s, %s, %s", object_name, object_data, result, extra={"action": "fail", "object_type": object_name})
+
+    async def sync_async(self, objects_data, resume=False):
+        self.start_journal(resume)
+        if resume and self.journal:
+            objects_data = {x: [z for z in y if not self.journal.journaled(x, z)] for x, y in objects_data.items()}
+        dependencies = self.sync_dependencies(objects_data.keys())
+        errors = {x: [] for x in objects_data}
+        tasks = dict()
+
+        async def run_type(object_name):
+            await asyncio.gather(*[tasks[x] for x in dependencies[object_name]])
+            await self.sync_type_async(object_name, objects_data[object_name], errors[object_name])
+
+        pending = set(dependencies)
+        while pending:
+            ready = {x for x in pending if dependencies[x] <= set(tasks)}
+            if not ready:
+                raise Exception(f"Circular dependency between: {pending}")
+            for object_name in ready:
+                tasks[object_name] = asyncio.ensure_future(run_type(object_name))
+            pending -= ready
+        await asyncio.gather(*tasks.values())
+
+        return errors
+
+
+class SnapshotNetBox(NetBox):
+    def __init__(self, url, token, snapshot=None, **kwargs):
+        # Planned IDs are negative and must never reach stores shared with real syncs
+        persistent = sorted(x for x in ("id_cache", "fingerprints", "journal") if kwargs.get(x))
+        if persistent:
+            raise Exception(f"Snapshot plans do not support persistent stores: {persistent}")
+        super().__init__(url, token, **kwargs)
+        self.snapshot = snapshot or dict()
+        self.snapshot_indexes = dict()
+        self.changeset = {"create": [], "update": [], "delete": [], "unresolved": []}
+        self.planned_id = 0
+
+    def take_snapshot(self, object_names, path=None):
+        for object_name in object_names:
+            # Read live, get_all and filter_raw are overridden here to serve the snapshot itself
+            self.snapshot[object_name] = {x["id"]: x for x in NetBox.filter_raw(self, object_name, {})}
+        self.snapshot_indexes = dict()
+        if path:
+            self.save_snapshot(path)
+
+    def save_snapshot(self, path):
+        with open(path, "w") as snapshot_file:
+            json.dump({x: list(y.values()) for x, y in self.snapshot.items()}, snapshot_file)
+
+    def load_snapshot(self, path):
+        with open(path) as snapshot_file:
+            self.snapshot = {x: {z["id"]: z for z in y} for x, y in json.load(snapshot_file).items()}
+        self.snapshot_indexes = dict()
+
+    def nb_record(self, object_name, values):
+        nb_record = super().nb_record(object_name, values)
+        # Fields missing from the snapshot must not be lazily fetched from the live API
+        nb_record.has_details = True
+        return nb_record
+
+    def snapshot_key(self, values, fields):
+        return self.nb_cache_key({x: self.nb_record_value(values, x) for x in fields})
+
+    def snapshot_index(self, object_name, fields):
+        index_name = (object_name, fields)
+        if index_name not in self.snapshot_indexes:
+            snapshot_index = dict()
+            for nb_id, values in self.snapshot.get(object_name, {}).items():
+                snapshot_index.setdefault(self.snapshot_key(values, fields), []).append(nb_id)
+            self.snapshot_indexes[index_name] = snapshot_index
+        return self.snapshot_indexes[index_name]
+
+    def filter_raw(self, object_name, lookup_clause, fields=None, page_size=None):
+        snapshot = self.snapshot.get(object_name, {})
+        lookup_clause = {x: y for x, y in lookup_clause.items() if x != "brief"}
+        if not lookup_clause:
+            return list(snapshot.values())
+        if any("__" in x for x in lookup_clause):
+            raise Exception(f"Lookup {lookup_clause} is not supported against a snapshot")
+
+        # Multi-value filters match any of their values, expand them into single-value keys
+        lookup_fields = tuple(sorted(lookup_clause))
+        value_lists = [y if isinstance(y, list) else [y] for _, y in sorted(lookup_clause.items())]
+        snapshot_index = self.snapshot_index(object_name, lookup_fields)
+        nb_ids = []
+        for values in itertools.product(*value_lists):
+            nb_ids += snapshot_index.get(self.nb_cache_key(dict(zip(lookup_fields, values))), [])
+        return [snapshot[x] for x in dict.fromkeys(nb_ids)]
+
+    def filter_object(self, object_name, lookup_clause, page_size=None):
+        return [self.nb_record(object_name, x) for x in self.filter_raw(object_name, lookup_clause)]
+
+    def get_object(self, object_name, lookup_clause):
+        nb_records = self.filter_object(object_name, lookup_clause)
+        if len(nb_records) > 1:
+            raise ValueError(f"get() returned more than one result for {object_name}, with data: {lookup_clause}")
+        return nb_records[0] if nb_records else None
+
+    def get_all(self, object_name, page_size=None):
+        return self.filter_object(object_name, {})
+
+    def create_object(self, object_name, object_data):
+        nb_records = []
+        for item_data in object_data if isinstance(object_data, list) else [object_data]:
+            # Planned objects get negative IDs so later records can reference them
+            self.planned_id -= 1
+            values = {**item_data, "id": self.planned_id}
+            self.snapshot.setdefault(object_name, {})[self.planned_id] = values
+            for (index_type, fields), snapshot_index in self.snapshot_indexes.items():
+                if index_type == object_name:
+                    snapshot_index.setdefault(self.snapshot_key(values, fields), []).append(self.planned_id)
+            self.changeset["create"].append({"object_type": object_name, "id": self.planned_id, "data": item_data})
+            nb_records.append(self.nb_record(object_name, values))
+        return nb_records if isinstance(object_data, list) else nb_records[0]
+
+    def update_objects(self, object_name, objects_data):
+        nb_records = []
+        for item_data in objects_data:
+            object_diff = {x: y for x, y in item_data.items() if x != "id"}
+            values = self.snapshot[object_name][item_data["id"]]
+            values.update(object_diff)
+            self.changeset["update"].append({"object_type": object_name, "id": item_data["id"], "diff": object_diff})
+            nb_records.append(self.nb_record(object_name, values))
+        self.snapshot_indexes = {x: y for x, y in self.snapshot_indexes.items() if x[0] != object_name}
+        return nb_records
+
+    def delete_object(self, object_name, nb_ids):
+        for nb_id in nb_ids:
+            self.snapshot[object_name].pop(nb_id, None)
+            self.changeset["delete"].append({"object_type": object_name, "id": nb_id})
+        self.snapshot_indexes = {x: y for x, y in self.snapshot_indexes.items() if x[0] != object_name}
+        return True
+
+    def plan(self, objects_data, prune_scopes=None, max_delete_ratio=0.1):
+        self.changeset = {"create": [], "update": [], "delete": [], "unresolved": []}
+        for object_name in self.sync_order(objects_data.keys()):
+            for object_data in objects_data[object_name]:
+                source_data = dict(object_data)
+                try:
+                    self.create_update_object(object_name, object_data)
+                except Exception as e:
+                    self.changeset["unresolved"].append({"object_type": object_name, "data": source_data, "error": str(e)})
+                    self.record_failure(object_name, [source_data], e)
+        # Types with unresolved records are left unpruned, the plan still reports everything else
+        prune_scopes = {x: y for x, y in (prune_scopes or {}).items() if not self.failed_counts[x]}
+        if prune_scopes:
+            self.prune_objects(prune_scopes, max_delete_ratio)
+        return self.changeset
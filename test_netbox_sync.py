@@ -0,0 +1,372 @@
+import asyncio
+import copy
+import json
+import threading
+
+import pytest
+
+from benchmark import FakeNetBox, generate_scenario, scenario_records
+from netbox_sync import (
+    AdaptiveLimiter, AsyncNetBox, NetBox, NetBoxHTTPAdapter, SnapshotNetBox, SqliteFingerprintStore, SqliteIdCache,
+    SyncJournal,
+)
+
+WRITE_VERBS = ("POST", "PATCH", "DELETE")
+
+
+@pytest.fixture
+def fake_nb():
+    fake_nb = FakeNetBox().start()
+    yield fake_nb
+    fake_nb.stop()
+
+
+@pytest.fixture
+def scenario():
+    return generate_scenario(sites=2, devices=4, interfaces=16, vlans_per_site=2, regions=2, device_types=2)
+
+
+def writes(fake_nb):
+    # GraphQL queries are POSTs too, but only read
+    return {x: y for x, y in fake_nb.store.requests.items() if x[0] in WRITE_VERBS and x[1] != "graphql"}
+
+
+def stored(fake_nb, endpoint):
+    return list(fake_nb.store.objects.get(endpoint, {}).values())
+
+
+def test_bulk_sync_creates_scenario(fake_nb, scenario):
+    errors = NetBox(fake_nb.url, "x").sync_ndjson(scenario_records(scenario))
+
+    assert not any(errors.values())
+    assert len(stored(fake_nb, "dcim/devices")) == 4
+    assert len(stored(fake_nb, "dcim/interfaces")) == 16
+    assert len(stored(fake_nb, "ipam/vlans")) == 4
+    assert len(stored(fake_nb, "ipam/ip-addresses")) == 4
+
+
+@pytest.mark.parametrize("use_graphql", [False, True])
+def test_rerun_with_caches_is_drift_free(fake_nb, scenario, tmp_path, use_graphql):
+    def run():
+        nb = NetBox(
+            fake_nb.url, "x",
+            id_cache=SqliteIdCache(str(tmp_path / "ids.db")),
+            fingerprints=SqliteFingerprintStore(str(tmp_path / "fingerprints.db")),
+            use_graphql=use_graphql,
+        )
+        drift = nb.validate_cache(list(scenario) + ["ip_addresses"])
+        errors = nb.sync_ndjson(scenario_records(scenario))
+        nb.id_cache.close()
+        nb.fingerprints.close()
+        return drift, errors
+
+    run()
+    run()
+    fake_nb.store.requests.clear()
+    drift, errors = run()
+
+    assert not any(errors.values())
+    assert not any(x["changed"] or x["deleted"] for x in drift.values())
+    assert writes(fake_nb) == {}
+
+
+def test_sync_updates_changed_fields_only(fake_nb, scenario):
+    NetBox(fake_nb.url, "x").sync_ndjson(scenario_records(scenario))
+    changed = copy.deepcopy(scenario)
+    changed["interfaces"][3]["description"] = "uplink"
+    fake_nb.store.requests.clear()
+
+    NetBox(fake_nb.url, "x").sync_ndjson(scenario_records(changed))
+
+    assert writes(fake_nb) == {("PATCH", "dcim/interfaces"): 1}
+    assert "uplink" in [x["description"] for x in stored(fake_nb, "dcim/interfaces")]
+
+
+def test_prune_deletes_untouched_objects(fake_nb, scenario):
+    NetBox(fake_nb.url, "x").sync_ndjson(scenario_records(scenario))
+    removed = scenario["devices"].pop()
+    scenario["interfaces"] = [x for x in scenario["interfaces"] if x["device"] != removed["name"]]
+
+    nb = NetBox(fake_nb.url, "x")
+    nb.sync_ndjson(scenario_records(scenario))
+    pruned = nb.prune_objects({"interfaces": None, "devices": None}, max_delete_ratio=0.5)
+
+    assert len(pruned["devices"]) == 1
+    assert len(pruned["interfaces"]) == 4
+    assert removed["name"] not in [x["name"] for x in stored(fake_nb, "dcim/devices")]
+
+
+def test_prune_refuses_types_with_failed_records(fake_nb, scenario):
+    NetBox(fake_nb.url, "x").sync_ndjson(scenario_records(scenario))
+    scenario["devices"][0]["device_type"] = "unknown-model"
+
+    nb = NetBox(fake_nb.url, "x")
+    errors = nb.sync(scenario)
+
+    assert len(errors["devices"]) == 1
+    with pytest.raises(Exception, match="failed to sync"):
+        nb.prune("devices", max_delete_ratio=1)
+    with pytest.raises(Exception, match="failed to sync"):
+        nb.prune_objects({"devices": None}, max_delete_ratio=1)
+    assert len(stored(fake_nb, "dcim/devices")) == 4
+
+
+def run_async(fake_nb, objects_data, **kwargs):
+    async def sync():
+        async with AsyncNetBox(fake_nb.url, "x", **kwargs) as nb:
+            return nb, await nb.sync_async(objects_data)
+    return asyncio.run(sync())
+
+
+def test_async_sync_indexes_devices(fake_nb, scenario):
+    del scenario["interfaces"]
+    nb, errors = run_async(fake_nb, scenario)
+
+    assert not any(errors.values())
+    assert sorted(nb.device_index) == sorted(x["name"] for x in stored(fake_nb, "dcim/devices"))
+
+
+def test_async_sync_creates_absent_vlans_without_deadlock(fake_nb, scenario):
+    del scenario["vlans"]
+    result = []
+    worker = threading.Thread(target=lambda: result.append(run_async(fake_nb, scenario, auto_create_tags=True)))
+    worker.daemon = True
+    worker.start()
+    worker.join(60)
+
+    assert not worker.is_alive(), "sync_async deadlocked"
+    _, errors = result[0]
+    assert not any(errors.values())
+    assert sorted((x["site"], x["vid"]) for x in stored(fake_nb, "ipam/vlans")) == [(1, 100), (1, 101), (2, 100), (2, 101)]
+
+
+def test_snapshot_plan_against_live_objects(fake_nb):
+    NetBox(fake_nb.url, "x").sync({"sites": [{"name": "s1"}, {"name": "s2"}]})
+    nb = SnapshotNetBox(fake_nb.url, "x")
+    nb.take_snapshot(["sites"])
+    fake_nb.store.requests.clear()
+
+    changeset = nb.plan({"sites": [{"name": "s1", "description": "edge"}, {"name": "s3"}]})
+
+    assert sorted(x["name"] for x in nb.snapshot["sites"].values()) == ["s1", "s2", "s3"]
+    assert [x["data"]["name"] for x in changeset["create"]] == ["s3"]
+    assert [x["diff"] for x in changeset["update"]] == [{"description": "edge"}]
+    assert writes(fake_nb) == {}
+
+
+def test_numeric_looking_strings_are_compared_as_strings(fake_nb):
+    NetBox(fake_nb.url, "x").sync({"sites": [{"name": "s1", "description": "1.1"}]})
+    fake_nb.store.requests.clear()
+
+    NetBox(fake_nb.url, "x").sync({"sites": [{"name": "s1", "description": "1.10"}]})
+
+    assert writes(fake_nb) == {("PATCH", "dcim/sites"): 1}
+    assert stored(fake_nb, "dcim/sites")[0]["description"] == "1.10"
+    assert NetBox.nb_diff({"serial": "007"}, {"serial": "7"}) == {"serial": "7"}
+    assert NetBox.nb_diff({"mtu": 1500.0, "speed": 1000, "tags": [{"id": 2}, {"id": 1}]}, {
+        "mtu": 1500, "speed": "1000", "tags": [1, 2],
+    }) == {}
+
+
+def test_bulk_merges_duplicate_records(fake_nb):
+    nb = NetBox(fake_nb.url, "x")
+    nb_ids = nb.bulk_create_update("sites", [
+        {"name": "s1", "description": "a"}, {"name": "s2"}, {"name": "s1", "description": "b"},
+    ])
+
+    sites = {x["name"]: x for x in stored(fake_nb, "dcim/sites")}
+    assert sorted(sites) == ["s1", "s2"]
+    assert sites["s1"]["description"] == "b"
+    assert nb_ids == [sites["s1"]["id"], sites["s2"]["id"], sites["s1"]["id"]]
+
+
+def test_validate_cache_on_fresh_cache_async(fake_nb, tmp_path):
+    async def validate():
+        async with AsyncNetBox(fake_nb.url, "x", id_cache=SqliteIdCache(str(tmp_path / "ids.db"))) as nb:
+            return await nb.loop.run_in_executor(nb.executor, nb.validate_cache, ["sites", "devices"])
+
+    drift = asyncio.run(validate())
+
+    assert drift == {x: {"changed": [], "deleted": []} for x in ("sites", "devices")}
+    assert ("GET", "dcim/sites") not in fake_nb.store.requests
+
+
+def test_validate_cache_chunks_cached_ids(fake_nb, tmp_path):
+    NetBox(fake_nb.url, "x").sync({"sites": [{"name": f"s{i}"} for i in range(7)]})
+    id_cache = SqliteIdCache(str(tmp_path / "ids.db"))
+    # Rows cached without last_updated and no cursor yet leave only the ID listing
+    for nb_site in stored(fake_nb, "dcim/sites"):
+        id_cache.set("sites", f"name={nb_site['name']}", nb_site["id"])
+    nb = NetBox(fake_nb.url, "x", id_cache=id_cache)
+    nb.lookup_chunk_size = 3
+    fake_nb.store.requests.clear()
+
+    drift = nb.validate_cache(["sites"])
+
+    assert len(drift["sites"]["changed"]) == 7
+    assert fake_nb.store.requests[("GET", "dcim/sites")] == 3
+
+
+def test_prometheus_families_are_contiguous(fake_nb, scenario):
+    nb = NetBox(fake_nb.url, "x")
+    nb.sync_ndjson(scenario_records(scenario))
+
+    families = []
+    for line in nb.metrics.to_prometheus().splitlines():
+        if line.startswith("# TYPE "):
+            families.append(line.split()[2])
+        elif not line.startswith("#"):
+            name = line.split("{")[0]
+            family = families[-1]
+            assert name == family or name.rsplit("_", 1)[0] == family, f"{name} outside its family {family}"
+    assert "netbox_sync_normalization_calls_total" in families
+    assert len(families) == len(set(families))
+
+
+def test_sharded_sync_places_existing_devices_by_site(fake_nb):
+    scenario = generate_scenario(sites=1, devices=4, interfaces=16, vlans_per_site=2, regions=1, device_types=1)
+    interfaces = scenario.pop("interfaces")
+    del scenario["vlans"]
+    NetBox(fake_nb.url, "x").sync(scenario)
+
+    nb = NetBox(fake_nb.url, "x")
+    assert len(nb.shard_records({"interfaces": interfaces}, 4)) == 1
+    errors = nb.sync_sharded({"interfaces": interfaces}, processes=4)
+
+    assert not any(errors.values())
+    assert len(stored(fake_nb, "dcim/interfaces")) == 16
+    assert sorted(x["vid"] for x in stored(fake_nb, "ipam/vlans")) == [100, 101]
+
+
+def test_snapshot_refuses_persistent_stores(fake_nb, tmp_path):
+    with pytest.raises(Exception, match="persistent stores"):
+        SnapshotNetBox(fake_nb.url, "x", id_cache=SqliteIdCache(str(tmp_path / "ids.db")))
+
+
+def test_planned_ids_in_stores_are_ignored(fake_nb, tmp_path):
+    pending = NetBox(fake_nb.url, "x").prepare_write("sites", {"name": "new-site"})
+    cache_key = NetBox.nb_cache_key(pending.lookup_clause)
+    id_cache = SqliteIdCache(str(tmp_path / "ids.db"))
+    id_cache.set("sites", cache_key, -1)
+    fingerprints = SqliteFingerprintStore(str(tmp_path / "fingerprints.db"))
+    fingerprints.set_many("sites", [(cache_key, pending.fingerprint, -1)])
+
+    errors = NetBox(fake_nb.url, "x", id_cache=id_cache, fingerprints=fingerprints).sync({"sites": [{"name": "new-site"}]})
+
+    assert not any(errors.values())
+    assert [x["name"] for x in stored(fake_nb, "dcim/sites")] == ["new-site"]
+
+
+def test_validate_cache_keeps_ambiguous_names_uncached(fake_nb, tmp_path):
+    racks = [{"name": "R1", "site": "A"}, {"name": "R1", "site": "B"}]
+    NetBox(fake_nb.url, "x").sync({"sites": [{"name": "A"}, {"name": "B"}], "racks": racks})
+    id_cache = SqliteIdCache(str(tmp_path / "ids.db"))
+    NetBox(fake_nb.url, "x", id_cache=id_cache).warm_cache(["racks"])
+    NetBox(fake_nb.url, "x").sync({"racks": [{"name": "R1", "site": "B", "description": "moved"}]})
+
+    nb = NetBox(fake_nb.url, "x", id_cache=id_cache)
+    drift = nb.validate_cache(["racks"])
+
+    assert len(drift["racks"]["changed"]) == 1
+    assert NetBox.nb_cache_key({"name": "R1"}) not in nb.nb_id_cache["racks"]
+    assert NetBox.nb_cache_key({"name": "R1"}) not in id_cache.load("racks")
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_failed_prefetch_only_fails_records_at_fault(fake_nb, monkeypatch, use_async):
+    nb_class = AsyncNetBox if use_async else NetBox
+    create_object = nb_class.create_object
+
+    def reject_tag(self, object_name, object_data):
+        if object_name == "tags" and "bad" in [x["name"] for x in object_data]:
+            raise Exception("tag rejected")
+        return create_object(self, object_name, object_data)
+
+    monkeypatch.setattr(nb_class, "create_object", reject_tag)
+    sites = {"sites": [{"name": "s1", "tags": ["good"]}, {"name": "s2", "tags": ["bad"]}]}
+    if use_async:
+        _, errors = run_async(fake_nb, sites, auto_create_tags=True)
+    else:
+        errors = NetBox(fake_nb.url, "x", auto_create_tags=True).sync(sites)
+
+    assert [x for x, _ in errors["sites"]] == [{"name": "s2", "tags": ["bad"]}]
+    assert [x["name"] for x in stored(fake_nb, "dcim/sites")] == ["s1"]
+
+
+def test_interfaces_of_deleted_cached_device_fail_explicitly(fake_nb, scenario, tmp_path):
+    interfaces = scenario.pop("interfaces")
+    NetBox(fake_nb.url, "x", id_cache=SqliteIdCache(str(tmp_path / "ids.db"))).sync(scenario)
+    deleted = stored(fake_nb, "dcim/devices")[0]
+    fake_nb.store.delete("dcim/devices", deleted["id"])
+
+    nb = NetBox(fake_nb.url, "x", id_cache=SqliteIdCache(str(tmp_path / "ids.db")))
+    with pytest.raises(Exception, match="Unable to find devices"):
+        nb.create_update_object("interfaces", [x for x in interfaces if x["device"] == deleted["name"]][0])
+    errors = nb.sync({"interfaces": interfaces})
+
+    assert [x for x, _ in errors["interfaces"]] == [x for x in interfaces if x["device"] == deleted["name"]]
+    assert deleted["id"] not in [x["device"] for x in stored(fake_nb, "dcim/interfaces")]
+
+
+def test_journal_resume_skips_synced_records(fake_nb, scenario, tmp_path):
+    del scenario["interfaces"]
+    scenario["devices"][0]["device_type"] = "unknown-model"
+    journal_path = str(tmp_path / "journal.ndjson")
+    nb = NetBox(fake_nb.url, "x", journal=SyncJournal(journal_path))
+    errors = nb.sync(copy.deepcopy(scenario))
+    nb.journal.close()
+
+    assert len(errors["devices"]) == 1
+    with open(f"{journal_path}.quarantine.ndjson") as quarantine_file:
+        quarantined = [json.loads(x) for x in quarantine_file]
+    assert [(x["object_type"], x["data"]) for x in quarantined] == [("devices", scenario["devices"][0])]
+    assert "Unable to find device_types" in quarantined[0]["error"]
+
+    scenario["devices"][0]["device_type"] = "model-0"
+    fake_nb.store.requests.clear()
+    nb = NetBox(fake_nb.url, "x", journal=SyncJournal(journal_path))
+    errors = nb.sync(copy.deepcopy(scenario), resume=True)
+    nb.journal.close()
+
+    assert not any(errors.values())
+    # Only the fixed record is written, its site and role come from the journal instead of the API
+    assert writes(fake_nb) == {("POST", "dcim/devices"): 1}
+    assert ("GET", "dcim/sites") not in fake_nb.store.requests
+    assert {x["name"]: x["id"] for x in stored(fake_nb, "dcim/sites")} == {
+        x.split("=", 1)[1]: y for x, y in nb.nb_id_cache["sites"].items()
+    }
+    assert len(stored(fake_nb, "dcim/devices")) == 4
+    with open(f"{journal_path}.quarantine.ndjson") as quarantine_file:
+        assert quarantine_file.read() == ""
+
+
+def test_throttled_sync_retries_to_completion(scenario):
+    fake_nb = FakeNetBox(throttle_rate=0.2).start()
+    try:
+        nb = NetBox(fake_nb.url, "x", retry_backoff=0.01)
+        errors = nb.sync(scenario)
+        throttled = sum(y for x, y in fake_nb.store.requests.items() if x[1] == "throttled")
+    finally:
+        fake_nb.stop()
+
+    assert not any(errors.values())
+    assert len(stored(fake_nb, "dcim/interfaces")) == 16
+    assert sum(nb.metrics.retries.values()) == throttled > 0
+
+
+def test_retry_delay_honors_retry_after():
+    assert NetBoxHTTPAdapter.retry_delay("2", 3, 0.5, 60) == 2
+    assert NetBoxHTTPAdapter.retry_delay("600", 0, 0.5, 60) == 60
+    assert NetBoxHTTPAdapter.retry_delay("Thu, 01 Jan 1970 00:00:00 GMT", 0, 0.5, 60) == 0
+    assert 0 <= NetBoxHTTPAdapter.retry_delay(None, 2, 0.5, 60) <= 2
+
+
+def test_adaptive_limiter_backs_off_and_recovers():
+    limiter = AdaptiveLimiter(max_limit=8)
+    limiter.acquire()
+    limiter.release("GET", 0.01, overloaded=True)
+    assert limiter.limit == 8 * limiter.backoff_ratio
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release("GET", 0.01)
+    assert limiter.limit == 8